@@ -1,22 +1,57 @@
+import argparse
+import atexit
 import json
-import os.path
-from typing import List
+import os
+import time
+
+_imports_start = time.perf_counter()
+
+from contextlib import contextmanager
+from typing import Dict, List
 from datetime import datetime
 
 from models.userProfileModel import UserProfileModel
 from models.popularityModel import PopularityModel
 from models.targetModel import TargetModel
+from models.playlistCache import PlaylistCache
 from data.dataFunctions import (
     get_played_songs_for_user_id,
     get_songs_by_traks_ids,
 )
-from data.loadData import load_users, load_tracks, load_artists, load_sessions
+from data.sessionIndex import SessionIndex
+from data.eventLog import EventLog
+from data.trackFeatureStore import TrackFeatureStore
+from data.loadData import (
+    _cached_directory,
+    _save_cached_directory,
+    source_hash,
+    load_users,
+    load_track_store,
+    load_artists,
+    load_sessions,
+)
+
+# seconds spent in each startup step, reported with --timings
+startup_times: Dict[str, float] = {
+    "imports": time.perf_counter() - _imports_start
+}
 
 # Global scope variables
 base_model: UserProfileModel
 target_model: TargetModel
+# fitted models by A/B arm, built on first use
+models: Dict[str, object] = {}
+# a model snapshot is reused while these data files are unchanged
+model_sources = ["users", "tracks", "artists", "sessions"]
+# end of the feedback folded into each arm's snapshot, saved beside it
+log_positions: Dict[str, tuple] = {}
+log_position_filename = "log_position.json"
 log_filename = "log.json"
-sessions: List
+event_log = EventLog(log_filename)
+# one memory-mapped track store backs both arms
+tracks: TrackFeatureStore = None
+sessions: SessionIndex = None
+playlist_cache = PlaylistCache()
 default_session_id = 60000
 
 # from witch user_id the base model will create playlist
@@ -61,7 +96,7 @@ def get_users_id() -> int:
 
 def display_history(user_id: int):
     print("Loading...")
-    songs = get_played_songs_for_user_id(user_id, sessions)
+    songs = get_played_songs_for_user_id(user_id, get_sessions())
     print(f"User's (id={user_id}) song history:")
     for song in songs:
         print(f'\t* {song}')
@@ -82,12 +117,11 @@ def play_new_playlist(user_id: int, session_id: int):
         users.add(user)
     print("\nCreating the playlist...")
     # choosing model for generating playlist
-    if user_id > split_A_B:
-        songs = base_model.getPlaylist(list(users))
-        model_type = "base"
-    else:
-        songs = target_model.getPlaylist(list(users))
-        model_type = "target"
+    model_type = "base" if user_id > split_A_B else "target"
+    model = get_model(model_type)
+    songs = playlist_cache.get_or_compute(
+        model_type, users, 10, lambda: model.getPlaylist(list(users))
+    )
 
     display_playlist(songs, user_id, session_id, model_type)
 
@@ -125,42 +159,143 @@ def display_playlist(songs, user_id, session_id, model_type):
             }
         )
     print("\n*** End of the playlist ***\n")
-    with open(log_filename, "a") as file:
-        for entry in log:
-            json.dump(entry, file)
-            file.write("\n")
+    event_log.extend(log)
+    event_log.flush()
+    # fold the feedback into the loaded models without refitting them;
+    # the others replay it from the log when they are loaded
+    for model in models.values():
+        model.partial_fit(log)
+    # the user's history changed, so their groups' playlists are stale
+    playlist_cache.invalidate_user(user_id)
+
+
+@contextmanager
+def startup_step(name: str):
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        startup_times[name] = (
+            startup_times.get(name, 0.0) + time.perf_counter() - start
+        )
 
 
-def initialize_models():
-    global base_model, target_model, sessions
-    print("Loading...")
+def report_startup_times():
+    print("Startup time:")
+    for name, seconds in startup_times.items():
+        print(f"\t{name:<24} {seconds:8.3f} s")
+    print()
 
-    users = load_users()
-    tracks = load_tracks()
-    artists = load_artists()
-    sessions = load_sessions()
 
-    base_model = UserProfileModel()
-    base_model.fit(users, tracks, sessions)
+def _fit_base_model() -> UserProfileModel:
+    model = UserProfileModel()
+    model.fit(load_users(), get_tracks(), load_sessions())
+    return model
 
-    target_model = TargetModel()
-    target_model.fit(users, tracks, artists, sessions)
+
+def _fit_target_model() -> TargetModel:
+    model = TargetModel()
+    model.fit(load_users(), get_tracks(), load_artists(), load_sessions())
+    return model
+
+
+def get_model(model_type: str):
+    # Each A/B arm is loaded from its snapshot, or fitted and snapshotted,
+    # the first time one of its users asks for a playlist. Feedback logged
+    # since the snapshot was saved is folded in and the snapshot saved
+    # again, so the next start reads only what is logged after that.
+    if model_type not in models:
+        if model_type == "base":
+            model_class, build = UserProfileModel, _fit_base_model
+        else:
+            model_class, build = TargetModel, _fit_target_model
+        name = os.path.join("models", model_type)
+
+        def load(path: str):
+            with open(os.path.join(path, log_position_filename), "r") as file:
+                position = json.load(file)
+            model = model_class.load(
+                path, get_tracks(), source_hash=source_hash(model_sources)
+            )
+            log_positions[model_type] = position and tuple(position)
+            return model
+
+        def save(model, path: str) -> None:
+            model.save(path, source_hash(model_sources))
+            with open(os.path.join(path, log_position_filename), "w") as file:
+                json.dump(log_positions.get(model_type), file)
+
+        def fit():
+            # a fitted model has absorbed none of the log
+            log_positions[model_type] = None
+            return build()
+
+        with startup_step(f"{model_type} model"):
+            model = _cached_directory(name, model_sources, fit, load, save)
+        with startup_step(f"{model_type} feedback"):
+            start = log_positions.get(model_type)
+            stop = event_log.position()
+            if start != stop:
+                for events in event_log.iter_events(start=start, stop=stop):
+                    model.partial_fit(events)
+                log_positions[model_type] = stop
+                _save_cached_directory(name, model_sources, model, save)
+        models[model_type] = model
+    return models[model_type]
+
+
+def get_tracks() -> TrackFeatureStore:
+    global tracks
+    if tracks is None:
+        with startup_step("track store"):
+            tracks = load_track_store()
+    return tracks
+
+
+def get_sessions() -> SessionIndex:
+    global sessions
+    if sessions is None:
+        with startup_step("sessions index"):
+            sessions = SessionIndex(load_sessions())
+    return sessions
+
+
+def initialize_models():
+    global base_model, target_model
+    print("Loading...")
+    base_model = get_model("base")
+    target_model = get_model("target")
 
 
 def initialize_session_id():
-    session_id = default_session_id
-    if os.path.isfile(log_filename):
-        with open(log_filename, "r") as file:
-            # getting last session_id from log
-            session_id = int(list(file)[-1].split()[1][:-1]) + 1
-    return session_id
+    # getting last session_id from the end of the log
+    last_session_id = event_log.last_session_id()
+    if last_session_id is None:
+        return default_session_id
+    return last_session_id + 1
 
 
 def main():
+    parser = argparse.ArgumentParser(description="Playlist client")
+    parser.add_argument(
+        "--eager",
+        action="store_true",
+        help="load both models before the first prompt",
+    )
+    parser.add_argument(
+        "--timings", action="store_true", help="print the startup times"
+    )
+    args = parser.parse_args()
+
     display_welcome_banner()
 
-    initialize_models()
+    if args.eager:
+        initialize_models()
     session_id = initialize_session_id()
+    if args.timings:
+        report_startup_times()
+        # models are loaded lazily, so report again with them at exit
+        atexit.register(report_startup_times)
 
     logged_in = False
     while not logged_in:
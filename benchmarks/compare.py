@@ -0,0 +1,49 @@
+import argparse
+import json
+from typing import Dict
+
+# slowdowns above this ratio are flagged
+default_threshold = 1.2
+
+
+def compare(baseline: Dict, current: Dict, threshold=default_threshold) -> bool:
+    # prints the median of every timing in both runs and returns False when
+    # any of them regressed past the threshold
+    ok = True
+    print(f"{'benchmark':<45} {'baseline':>12} {'current':>12} {'ratio':>7}")
+    for name, timing in current["results"].items():
+        before = baseline["results"].get(name)
+        if before is None:
+            print(f"{name:<45} {'-':>12} {timing['median'] * 1000:>12.3f}")
+            continue
+        ratio = timing["median"] / max(before["median"], 1e-9)
+        flag = ""
+        if ratio > threshold:
+            flag = "  slower"
+            ok = False
+        print(
+            f"{name:<45} {before['median'] * 1000:>12.3f} "
+            f"{timing['median'] * 1000:>12.3f} {ratio:>7.2f}{flag}"
+        )
+    return ok
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Compare benchmark results")
+    parser.add_argument("baseline")
+    parser.add_argument("current")
+    parser.add_argument("--threshold", type=float, default=default_threshold)
+    args = parser.parse_args()
+
+    with open(args.baseline, "r") as file:
+        baseline = json.load(file)
+    with open(args.current, "r") as file:
+        current = json.load(file)
+    if baseline.get("sizes") != current.get("sizes"):
+        print("Warning: the runs used data of different sizes")
+    if not compare(baseline, current, args.threshold):
+        exit(1)
+
+
+if __name__ == "__main__":
+    main()
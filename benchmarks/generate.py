@@ -0,0 +1,187 @@
+import argparse
+import json
+import os
+import numpy as np
+from typing import Dict
+
+# number of records written for every scale; sessions are events
+SCALES: Dict[str, Dict[str, int]] = {
+    "tiny": {"tracks": 10_000, "users": 1_000, "sessions": 50_000},
+    "small": {"tracks": 100_000, "users": 10_000, "sessions": 500_000},
+    "medium": {"tracks": 1_000_000, "users": 100_000, "sessions": 5_000_000},
+    "large": {"tracks": 5_000_000, "users": 1_000_000, "sessions": 20_000_000},
+}
+NUMBER_OF_GENRES = 300
+TRACKS_PER_ARTIST = 10
+FIRST_USER_ID = 101
+EVENT_TYPES = ["play", "skip", "like", "advertisment", "buy_premium"]
+EVENT_PROBABILITIES = [0.55, 0.25, 0.1, 0.08, 0.02]
+# records generated and written at a time
+CHUNK_SIZE = 100_000
+ID_ALPHABET = np.array(
+    list("0123456789ABCDEFGHIJKLMNOPQRSTUVWXYZabcdefghijklmnopqrstuvwxyz")
+)
+
+
+def _ids(rng: np.random.Generator, count: int) -> np.ndarray:
+    # 22 character ids like the Spotify ones in the real data
+    letters = ID_ALPHABET[rng.integers(0, len(ID_ALPHABET), (count, 22))]
+    return letters.view("<U22").ravel()
+
+
+def _write_lines(path: str, records) -> None:
+    with open(path, "w") as file:
+        for record in records:
+            file.write(json.dumps(record))
+            file.write("\n")
+
+
+def generate(
+    directory: str,
+    number_of_tracks: int,
+    number_of_users: int,
+    number_of_sessions: int,
+    seed=0,
+) -> None:
+    # Writes users, artists, tracks and sessions JSONL files with the same
+    # fields as the project data. Popularity and plays follow a skewed
+    # distribution so a few tracks dominate, like in the real logs.
+    rng = np.random.default_rng(seed)
+    os.makedirs(directory, exist_ok=True)
+    genres = np.array([f"genre {i}" for i in range(NUMBER_OF_GENRES)])
+    genre_weights = 1 / np.arange(1, NUMBER_OF_GENRES + 1)
+    genre_weights /= genre_weights.sum()
+
+    number_of_artists = max(1, number_of_tracks // TRACKS_PER_ARTIST)
+    artist_ids = _ids(rng, number_of_artists)
+    _write_lines(
+        os.path.join(directory, "artists.jsonl"),
+        (
+            {
+                "id": artist_id,
+                "name": f"Artist {i}",
+                "genres": rng.choice(
+                    genres, rng.integers(1, 5), replace=False, p=genre_weights
+                ).tolist(),
+            }
+            for i, artist_id in enumerate(artist_ids.tolist())
+        ),
+    )
+
+    _write_lines(
+        os.path.join(directory, "users.jsonl"),
+        (
+            {
+                "user_id": FIRST_USER_ID + i,
+                "name": f"User {i}",
+                "city": "Warszawa",
+                "street": f"ul. Testowa {i}",
+                "favourite_genres": rng.choice(
+                    genres, 3, replace=False, p=genre_weights
+                ).tolist(),
+                "premium_user": bool(rng.random() < 0.3),
+            }
+            for i in range(number_of_users)
+        ),
+    )
+
+    track_ids = _ids(rng, number_of_tracks)
+    with open(os.path.join(directory, "tracks.jsonl"), "w") as file:
+        for start in range(0, number_of_tracks, CHUNK_SIZE):
+            end = min(start + CHUNK_SIZE, number_of_tracks)
+            size = end - start
+            columns = {
+                "id": track_ids[start:end].tolist(),
+                "popularity": np.minimum(
+                    rng.pareto(2.0, size) * 15, 100
+                ).astype(int),
+                "duration_ms": rng.integers(60_000, 400_000, size),
+                "explicit": rng.integers(0, 2, size),
+                "id_artist": artist_ids[
+                    rng.integers(0, number_of_artists, size)
+                ].tolist(),
+                "release_date": rng.integers(1950, 2022, size),
+                "danceability": rng.random(size),
+                "energy": rng.random(size),
+                "key": rng.integers(0, 12, size),
+                "loudness": -rng.random(size) * 30,
+                "speechiness": rng.random(size),
+                "acousticness": rng.random(size),
+                "instrumentalness": rng.random(size),
+                "liveness": rng.random(size),
+                "valence": rng.random(size),
+                "tempo": rng.uniform(60, 200, size),
+            }
+            columns = {
+                name: values if isinstance(values, list) else values.tolist()
+                for name, values in columns.items()
+            }
+            for i in range(size):
+                track = {name: values[i] for name, values in columns.items()}
+                track["name"] = f"Song {start + i}"
+                track["release_date"] = f"{track['release_date']}-01-01"
+                file.write(json.dumps(track))
+                file.write("\n")
+
+    # plays concentrate on popular tracks
+    track_weights = 1 / np.arange(1, number_of_tracks + 1) ** 0.8
+    track_weights /= track_weights.sum()
+    with open(os.path.join(directory, "sessions.jsonl"), "w") as file:
+        for start in range(0, number_of_sessions, CHUNK_SIZE):
+            size = min(CHUNK_SIZE, number_of_sessions - start)
+            user_ids = rng.integers(
+                FIRST_USER_ID, FIRST_USER_ID + number_of_users, size
+            ).tolist()
+            tracks = track_ids[
+                rng.choice(number_of_tracks, size, p=track_weights)
+            ].tolist()
+            events = rng.choice(EVENT_TYPES, size, p=EVENT_PROBABILITIES)
+            for i, event_type in enumerate(events.tolist()):
+                with_track = event_type not in ("advertisment", "buy_premium")
+                session = {
+                    "session_id": (start + i) // 20,
+                    "timestamp": "2022-01-01T00:00:00.000000",
+                    "user_id": user_ids[i],
+                    "track_id": tracks[i] if with_track else None,
+                    "event_type": event_type,
+                }
+                file.write(json.dumps(session))
+                file.write("\n")
+
+
+def data_directory(scale: str, seed=0) -> str:
+    return os.path.join("benchmarks", "data", f"{scale}-{seed}")
+
+
+def generate_scale(scale: str, directory: str = None, seed=0) -> str:
+    directory = directory or data_directory(scale, seed)
+    sizes = SCALES[scale]
+    generate(
+        directory, sizes["tracks"], sizes["users"], sizes["sessions"], seed
+    )
+    return directory
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Synthetic benchmark data")
+    parser.add_argument("--scale", choices=SCALES, default="tiny")
+    parser.add_argument("--tracks", type=int, help="overrides the scale")
+    parser.add_argument("--users", type=int, help="overrides the scale")
+    parser.add_argument("--sessions", type=int, help="overrides the scale")
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--output", help="directory for the JSONL files")
+    args = parser.parse_args()
+
+    sizes = dict(SCALES[args.scale])
+    for name in ("tracks", "users", "sessions"):
+        if getattr(args, name) is not None:
+            sizes[name] = getattr(args, name)
+    directory = args.output or data_directory(args.scale, args.seed)
+    generate(
+        directory, sizes["tracks"], sizes["users"], sizes["sessions"], args.seed
+    )
+    print(f"Written to {directory}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,177 @@
+import argparse
+import json
+import os
+import platform
+import shutil
+import subprocess
+import time
+import numpy as np
+from datetime import datetime
+from typing import Callable, Dict
+
+from benchmarks.generate import SCALES, data_directory, generate_scale
+from data import loadData
+from models.userProfileModel import UserProfileModel
+from models.popularityModel import PopularityModel
+from models.targetModel import TargetModel
+
+GROUP_SIZES = [1, 5, 20]
+# tracks ranked per rank_tracks_for_users call, like in the evaluation
+NUMBER_OF_RANKED_TRACKS = 101
+# popular tracks seeding the two-stage ranking of the target model
+NUMBER_OF_CANDIDATES = 100
+
+
+def measure(function: Callable, repeat=1) -> Dict[str, float]:
+    times = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        function()
+        times.append(time.perf_counter() - start)
+    times = np.array(times)
+    return {
+        "runs": repeat,
+        "mean": float(times.mean()),
+        "median": float(np.median(times)),
+        "min": float(times.min()),
+        "max": float(times.max()),
+    }
+
+
+def _git_commit() -> str:
+    try:
+        return subprocess.run(
+            ["git", "rev-parse", "HEAD"],
+            capture_output=True,
+            text=True,
+            check=True,
+        ).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def run(data_dir: str, repeat=5, seed=0) -> Dict:
+    # Loaders are timed without the parse cache, so the numbers show the
+    # cost of the raw JSONL; the models are fitted on the track store.
+    loadData.DATA_DIR = data_dir
+    use_cache = loadData.use_cache
+    loadData.use_cache = False
+    results = {}
+    try:
+        results["_load_file[tracks]"] = measure(
+            lambda: loadData._load_file("tracks")
+        )
+        records = loadData._parse_file("tracks")
+        results["normalize_params"] = measure(
+            lambda: loadData.normalize_params(records)
+        )
+        del records
+        results["load_tracks"] = measure(loadData.load_tracks)
+        results["load_sessions"] = measure(loadData.load_sessions)
+        users = loadData.load_users()
+        artists = loadData.load_artists()
+        sessions = loadData.load_sessions()
+    finally:
+        loadData.use_cache = use_cache
+    shutil.rmtree(
+        os.path.join(data_dir, ".cache", "track_store"), ignore_errors=True
+    )
+    results["load_track_store[cold]"] = measure(loadData.load_track_store)
+    results["load_track_store[warm]"] = measure(
+        loadData.load_track_store, repeat
+    )
+    tracks = loadData.load_track_store()
+
+    models = {
+        "user_profile": (UserProfileModel(), (users, tracks, sessions)),
+        "popularity": (PopularityModel(), (users, tracks, artists)),
+        "target": (TargetModel(), (users, tracks, artists, sessions)),
+        "target_candidates": (
+            TargetModel(candidates=NUMBER_OF_CANDIDATES),
+            (users, tracks, artists, sessions),
+        ),
+    }
+    rng = np.random.default_rng(seed)
+    user_ids = users["user_id"].to_numpy()
+    for name, (model, fit_args) in models.items():
+        results[f"{name}.fit"] = measure(lambda: model.fit(*fit_args))
+        for group_size in GROUP_SIZES:
+            groups = [
+                rng.choice(user_ids, group_size, replace=False).tolist()
+                for _ in range(repeat)
+            ]
+            track_ids = [
+                tracks.track_ids[
+                    rng.integers(0, len(tracks), NUMBER_OF_RANKED_TRACKS)
+                ].tolist()
+                for _ in range(repeat)
+            ]
+            results[f"{name}.getPlaylist[{group_size}]"] = _measure_each(
+                lambda i: model.getPlaylist(groups[i]), repeat
+            )
+            results[f"{name}.rank_tracks_for_users[{group_size}]"] = (
+                _measure_each(
+                    lambda i: model.rank_tracks_for_users(
+                        groups[i], track_ids[i]
+                    ),
+                    repeat,
+                )
+            )
+    return results
+
+
+def _measure_each(function: Callable[[int], object], repeat: int) -> Dict:
+    # a different group on every run, so no run is served from a warm path
+    runs = iter(range(repeat))
+    return measure(lambda: function(next(runs)), repeat)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Loader and model timings")
+    parser.add_argument("--scale", choices=SCALES, default="tiny")
+    parser.add_argument("--data-dir", help="existing JSONL data to use")
+    parser.add_argument("--repeat", type=int, default=5)
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--output", help="JSON file for the results")
+    args = parser.parse_args()
+
+    data_dir = args.data_dir or data_directory(args.scale, args.seed)
+    if not os.path.isfile(os.path.join(data_dir, "tracks.jsonl")):
+        print(f"Generating {args.scale} data in {data_dir}...")
+        generate_scale(args.scale, data_dir, args.seed)
+
+    results = run(data_dir, args.repeat, args.seed)
+    report = {
+        "commit": _git_commit(),
+        "date": datetime.now().isoformat(timespec="seconds"),
+        "scale": None if args.data_dir else args.scale,
+        "data_dir": data_dir,
+        "sizes": {
+            name: _count_lines(os.path.join(data_dir, f"{name}.jsonl"))
+            for name in ("users", "artists", "tracks", "sessions")
+        },
+        "python": platform.python_version(),
+        "numpy": np.__version__,
+        "results": results,
+    }
+    for name, timing in results.items():
+        print(f"{name:<45} {timing['median'] * 1000:>12.3f} ms")
+
+    output = args.output or os.path.join(
+        "benchmarks",
+        "results",
+        f"{args.scale}-{(report['commit'] or 'unknown')[:8]}.json",
+    )
+    os.makedirs(os.path.dirname(output) or ".", exist_ok=True)
+    with open(output, "w") as file:
+        json.dump(report, file, indent=2)
+    print(f"Results written to {output}")
+
+
+def _count_lines(path: str) -> int:
+    with open(path, "rb") as file:
+        return sum(1 for _ in file)
+
+
+if __name__ == "__main__":
+    main()
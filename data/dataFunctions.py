@@ -1,37 +1,23 @@
-from data.loadData import _load_file, load_tracks
-from typing import List
+from data.loadData import _load_file, _source_signature, load_track_store
+from data.sessionIndex import SessionIndex
+from instrumentation import timed
+from functools import lru_cache
+from typing import List, Dict, Tuple, Union
 import pandas as pd
 import numpy as np
 
 
 def get_played_songs_for_user_id(
-    user_id: int, sessions: pd.DataFrame
+    user_id: int, sessions: Union[pd.DataFrame, SessionIndex]
 ) -> List[str]:
-    songs = {}
-    tracks = _load_file("tracks")
-    artists = _load_file("artists")
-    for i in range(len(sessions)):
-        if sessions.loc[i, "event"] != "advertisment":
-            if sessions.loc[i, "user_id"] == user_id:
-                if sessions.loc[i, "track_id"] not in songs:
-                    songs[sessions.loc[i, "track_id"]] = 1
-                else:
-                    songs[sessions.loc[i, "track_id"]] += 1
+    songs = SessionIndex.of(sessions).play_counts(user_id)
+    return get_song_names(list(songs))
 
-    song_names = []
-    for song in songs:
-        song_names.append(get_song_name_artist(song, tracks, artists))
-
-    return song_names
 
-
-def get_played_tracks(user_ids: List[int], sessions: List) -> List[str]:
-    songs = set()
-    for i in range(len(sessions)):
-        if sessions.loc[i, "user_id"] in user_ids:
-            songs.add(sessions.loc[i, "track_id"])
-
-    return list(songs)
+def get_played_tracks(
+    user_ids: List[int], sessions: Union[pd.DataFrame, SessionIndex]
+) -> List[str]:
+    return SessionIndex.of(sessions).distinct_tracks(user_ids)
 
 
 def get_song_name_artist(track_id: str, tracks: List, artists: List) -> str:
@@ -43,17 +29,38 @@ def get_song_name_artist(track_id: str, tracks: List, artists: List) -> str:
 
 
 def get_songs_by_traks_ids(track_ids: List[str]) -> List[str]:
-    tracks = _load_file("tracks")
-    artists = _load_file("artists")
-    return [
-        get_song_name_artist(track_id, tracks, artists)
-        for track_id in track_ids
-    ]
+    return get_song_names(track_ids)
+
+
+@timed("dataFunctions.get_song_names")
+def get_song_names(track_ids: List[str]) -> List[str]:
+    metadata = _track_metadata(tuple(_source_signature(["tracks", "artists"])))
+    song_names = []
+    for track_id in track_ids:
+        name, artist_name = metadata.get(track_id, (None, None))
+        if artist_name is None:
+            song_names.append(None)
+        else:
+            song_names.append('"' + name + '" - ' + artist_name)
+    return song_names
+
+
+@lru_cache(maxsize=1)
+def _track_metadata(signature: Tuple) -> Dict[str, Tuple[str, str]]:
+    # track_id -> (name, artist name), rebuilt only when the source files
+    # change (the signature is part of the cache key)
+    artist_names = {
+        artist["id"]: artist["name"] for artist in _load_file("artists")
+    }
+    return {
+        track["id"]: (track["name"], artist_names.get(track["id_artist"]))
+        for track in _load_file("tracks")
+    }
 
 
 def find_random_n_track_ids(n_of_tracks: int) -> List[str]:
-    tracks = load_tracks()
-    return np.random.choice(tracks["track_id"], size=n_of_tracks)
+    tracks = load_track_store()
+    return np.random.choice(tracks.track_ids, size=n_of_tracks)
 
 
 def get_tracks_dataset(track_ids: List[str]) -> pd.DataFrame:
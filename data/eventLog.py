@@ -0,0 +1,214 @@
+import glob
+import json
+import os
+import threading
+import pandas as pd
+from typing import Dict, Iterator, List, Tuple
+
+from data.loadData import _sessions_frame
+
+FSYNC_POLICIES = ("always", "batch", "never")
+default_segment_size = 64 * 1024 * 1024
+default_buffer_size = 256
+# bytes read at a time while looking for the last entry
+TAIL_BLOCK = 4096
+
+# (segment number, byte offset) of a point in the log
+Position = Tuple[int, int]
+
+
+class EventLog:
+    # Append-only JSON lines log of playlist feedback. Entries are buffered
+    # and written in batches; with the "batch" policy every write is also
+    # fsynced, "always" writes and fsyncs each entry and "never" leaves it to
+    # the OS. When the active file grows past segment_size it is renamed to
+    # <path>.<n> and a new one is started, so segments are numbered oldest
+    # first and the active file is always the newest. The active file counts
+    # as the number it will be renamed to, so positions survive rotation.
+    def __init__(
+        self,
+        path: str,
+        fsync="batch",
+        segment_size=default_segment_size,
+        buffer_size=default_buffer_size,
+    ) -> None:
+        if fsync not in FSYNC_POLICIES:
+            raise ValueError(f"Unknown fsync policy: {fsync}")
+        self.path = path
+        self.fsync = fsync
+        self.segment_size = segment_size
+        self.buffer_size = 1 if fsync == "always" else buffer_size
+        self.buffer: List[str] = []
+        self.file = None
+        self._lock = threading.Lock()
+
+    # ==================================================== writing
+
+    def append(self, entry: Dict) -> None:
+        self.extend([entry])
+
+    def extend(self, entries: List[Dict]) -> None:
+        with self._lock:
+            for entry in entries:
+                self.buffer.append(json.dumps(entry) + "\n")
+            if len(self.buffer) >= self.buffer_size:
+                self._write()
+
+    def flush(self) -> None:
+        with self._lock:
+            self._write()
+
+    def close(self) -> None:
+        with self._lock:
+            self._write()
+            if self.file is not None:
+                self.file.close()
+                self.file = None
+
+    def __enter__(self) -> "EventLog":
+        return self
+
+    def __exit__(self, *exc_info) -> None:
+        self.close()
+
+    def _write(self) -> None:
+        if not self.buffer:
+            return
+        if self.file is None:
+            self.file = open(self.path, "a")
+            if _torn(self.path):
+                # start after a line left unfinished by a crash
+                self.file.write("\n")
+        self.file.write("".join(self.buffer))
+        self.buffer = []
+        self.file.flush()
+        if self.fsync != "never":
+            os.fsync(self.file.fileno())
+        if self.file.tell() >= self.segment_size:
+            self._rotate()
+
+    def _rotate(self) -> None:
+        self.file.close()
+        self.file = None
+        numbers = [number for number, _ in self._rotated_segments()]
+        os.replace(self.path, f"{self.path}.{max(numbers, default=0) + 1}")
+
+    # ==================================================== reading
+
+    def _rotated_segments(self) -> List:
+        segments = []
+        for segment in glob.glob(glob.escape(self.path) + ".*"):
+            suffix = segment[len(self.path) + 1 :]
+            if suffix.isdigit():
+                segments.append((int(suffix), segment))
+        return sorted(segments)
+
+    def _numbered_segments(self) -> List[Tuple[int, str]]:
+        segments = self._rotated_segments()
+        if os.path.isfile(self.path):
+            numbers = [number for number, _ in segments]
+            segments.append((max(numbers, default=0) + 1, self.path))
+        return segments
+
+    def segments(self) -> List[str]:
+        # oldest first, the active file last
+        return [segment for _, segment in self._numbered_segments()]
+
+    def position(self) -> Position:
+        # the current end of the log, to read only what is appended later
+        with self._lock:
+            self._write()
+            numbers = [number for number, _ in self._rotated_segments()]
+            size = 0
+            if os.path.isfile(self.path):
+                size = os.path.getsize(self.path)
+        return max(numbers, default=0) + 1, size
+
+    def last_entry(self) -> Dict:
+        # Reads the newest segment backwards from its end, so the cost does
+        # not depend on the size of the log. A torn last line left by a
+        # crash is skipped.
+        with self._lock:
+            self._write()
+        for segment in reversed(self.segments()):
+            entry = _last_entry(segment)
+            if entry is not None:
+                return entry
+        return None
+
+    def last_session_id(self) -> int:
+        entry = self.last_entry()
+        return None if entry is None else entry["session_id"]
+
+    def iter_entries(
+        self, start: Position = None, stop: Position = None
+    ) -> Iterator[Dict]:
+        # entries from start (the beginning by default) up to stop (the
+        # end by default); earlier segments are not opened
+        with self._lock:
+            self._write()
+        for number, segment in self._numbered_segments():
+            if start is not None and number < start[0]:
+                continue
+            if stop is not None and number > stop[0]:
+                break
+            offset = start[1] if start is not None and number == start[0] else 0
+            end = stop[1] if stop is not None and number == stop[0] else None
+            with open(segment, "rb") as file:
+                file.seek(offset)
+                for line in file:
+                    offset += len(line)
+                    if end is not None and offset > end:
+                        break
+                    try:
+                        yield json.loads(line)
+                    except ValueError:
+                        # torn write at the end of a segment
+                        continue
+
+    def iter_events(
+        self, chunk_size=100_000, start: Position = None, stop: Position = None
+    ) -> Iterator[pd.DataFrame]:
+        # feedback in the same chunked shape as loadData.iter_sessions, so
+        # it can be folded into the models' per-user aggregates
+        useful_entries = []
+        for entry in self.iter_entries(start, stop):
+            useful_entries.append(
+                (entry["user_id"], entry["track_id"], entry["event_type"])
+            )
+            if len(useful_entries) >= chunk_size:
+                yield _sessions_frame(useful_entries)
+                useful_entries = []
+        if useful_entries:
+            yield _sessions_frame(useful_entries)
+
+
+def _last_entry(path: str) -> Dict:
+    with open(path, "rb") as file:
+        position = file.seek(0, os.SEEK_END)
+        data = b""
+        while position > 0:
+            step = min(TAIL_BLOCK, position)
+            position -= step
+            file.seek(position)
+            data = file.read(step) + data
+            lines = data.split(b"\n")
+            # the first line may continue in the block before this one
+            complete = lines[1:] if position > 0 else lines
+            for line in reversed(complete):
+                if not line.strip():
+                    continue
+                try:
+                    return json.loads(line)
+                except ValueError:
+                    continue
+            data = lines[0]
+    return None
+
+
+def _torn(path: str) -> bool:
+    with open(path, "rb") as file:
+        if file.seek(0, os.SEEK_END) == 0:
+            return False
+        file.seek(-1, os.SEEK_END)
+        return file.read(1) != b"\n"
@@ -1,23 +1,203 @@
+import hashlib
 import json
+import os
+import pickle
+import shutil
 import numpy as np
 import pandas as pd
-from typing import List, Dict
-from sklearn import preprocessing
-import matplotlib.pyplot as plt
+from pandas.api.types import union_categoricals
+from functools import wraps
+from typing import Callable, Iterator, List, Dict
 
+from data.trackFeatureStore import TrackFeatureStore
+from instrumentation import count, stage, timed
+
+
+DATA_DIR = "data"
+# track attributes making up the params vector of every track
+FEATURES = [
+    "duration_ms",
+    "release_date",
+    "danceability",
+    "energy",
+    "key",
+    "loudness",
+    "speechiness",
+    "acousticness",
+    "instrumentalness",
+    "liveness",
+    "valence",
+    "tempo",
+]
+# the reduced profile used by load_tracks_less
+LESS_FEATURES = [
+    "release_date",
+    "danceability",
+    "energy",
+    "key",
+    "loudness",
+    "acousticness",
+    "liveness",
+    "valence",
+    "tempo",
+]
+# bump when the shape of a cached loader result changes
+CACHE_VERSION = 1
+use_cache = True
+
+
+def _source_path(fname) -> str:
+    return os.path.join(DATA_DIR, f"{fname}.jsonl")
+
+
+def _cache_path(name) -> str:
+    return os.path.join(DATA_DIR, ".cache", f"{name}.pkl")
 
-def _load_file(fname) -> List[Dict]:
-    with open(f"data/{fname}.jsonl", "r") as file:
-        json_list = list(file)
 
-    result = []
-    for json_str in json_list:
-        result.append(json.loads(json_str))
+def _source_signature(fnames: List[str]) -> List:
+    signature = [CACHE_VERSION]
+    for fname in fnames:
+        stat = os.stat(_source_path(fname))
+        signature.append((fname, stat.st_mtime_ns, stat.st_size))
+    return signature
+
+
+def _cached(name: str, sources: List[str], build: Callable):
+    # The parsed result is pickled next to the data and reused for as long
+    # as the source files keep their mtime and size.
+    if not use_cache:
+        return build()
+    signature = _source_signature(sources)
+    path = _cache_path(name)
+    try:
+        with open(path, "rb") as file:
+            if pickle.load(file) == signature:
+                result = pickle.load(file)
+                count("loadData.cache_hits")
+                return result
+    except Exception:
+        # missing, stale or unreadable cache - rebuild it
+        pass
+
+    count("loadData.cache_misses")
+    result = build()
+    tmp_path = f"{path}.{os.getpid()}.tmp"
+    try:
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        with open(tmp_path, "wb") as file:
+            pickle.dump(signature, file, protocol=pickle.HIGHEST_PROTOCOL)
+            pickle.dump(result, file, protocol=pickle.HIGHEST_PROTOCOL)
+        os.replace(tmp_path, path)
+    except OSError:
+        pass
     return result
 
 
+def _cached_directory(
+    name: str,
+    sources: List[str],
+    build: Callable,
+    load: Callable[[str], object],
+    save: Callable[[object, str], None] = None,
+):
+    # Like _cached for results saved as a directory of .npy files, which
+    # are opened as memory maps instead of unpickled into memory.
+    if not use_cache:
+        return build()
+    save = save or (lambda result, directory: result.save(directory))
+    directory = os.path.join(DATA_DIR, ".cache", name)
+    signature = json.loads(json.dumps(_source_signature(sources)))
+    try:
+        with open(os.path.join(directory, "source.json"), "r") as file:
+            if json.load(file) == signature:
+                result = load(directory)
+                count("loadData.cache_hits")
+                return result
+    except (OSError, ValueError, KeyError):
+        pass
+
+    count("loadData.cache_misses")
+    result = build()
+    if not _save_cached_directory(name, sources, result, save):
+        return result
+    return load(directory)
+
+
+def _save_cached_directory(
+    name: str,
+    sources: List[str],
+    result,
+    save: Callable[[object, str], None] = None,
+) -> bool:
+    # (re)writes a _cached_directory entry, e.g. after the result changed
+    if not use_cache:
+        return False
+    save = save or (lambda result, directory: result.save(directory))
+    directory = os.path.join(DATA_DIR, ".cache", name)
+    tmp_directory = f"{directory}.{os.getpid()}.tmp"
+    try:
+        shutil.rmtree(tmp_directory, ignore_errors=True)
+        save(result, tmp_directory)
+        with open(os.path.join(tmp_directory, "source.json"), "w") as file:
+            json.dump(_source_signature(sources), file)
+        shutil.rmtree(directory, ignore_errors=True)
+        os.replace(tmp_directory, directory)
+    except OSError:
+        return False
+    return True
+
+
+def source_hash(fnames: List[str]) -> str:
+    # content hash of the source files, recorded in model snapshots; read
+    # once and then reused for as long as the files keep their mtime and
+    # size
+    name = "source_hash_" + "_".join(fnames)
+    return _cached(name, fnames, lambda: _hash_files(fnames))
+
+
+def _hash_files(fnames: List[str]) -> str:
+    digest = hashlib.sha256()
+    for fname in fnames:
+        digest.update(fname.encode())
+        with open(_source_path(fname), "rb") as file:
+            while block := file.read(1 << 20):
+                digest.update(block)
+    return digest.hexdigest()
+
+
+def _cached_loader(*sources: str) -> Callable:
+    def decorator(loader: Callable) -> Callable:
+        @wraps(loader)
+        def wrapper(*args, **kwargs):
+            # drawing graphs is a side effect the cache can't replay
+            if any(args) or kwargs.get("print_graphs"):
+                return loader(*args, **kwargs)
+            return _cached(loader.__name__, list(sources), loader)
+
+        return wrapper
+
+    return decorator
+
+
+def _parse_file(fname) -> List[Dict]:
+    with stage(f"loadData.parse.{fname}"):
+        with open(_source_path(fname), "r") as file:
+            json_list = list(file)
+
+        result = []
+        for json_str in json_list:
+            result.append(json.loads(json_str))
+        return result
+
+
+def _load_file(fname) -> List[Dict]:
+    return _cached(f"{fname}_records", [fname], lambda: _parse_file(fname))
+
+
+@timed("loadData.load_users")
+@_cached_loader("users")
 def load_users() -> pd.DataFrame:
-    users = _load_file("users")
+    users = _parse_file("users")
     useful_users = []
     for user in users:
         useful_users.append(
@@ -32,54 +212,72 @@ def load_users() -> pd.DataFrame:
     )
 
 
+@timed("loadData.load_artists")
+@_cached_loader("artists")
 def load_artists() -> pd.DataFrame:
-    artists = _load_file("artists")
+    artists = _parse_file("artists")
     useful_artists = []
     for artist in artists:
         useful_artists.append([artist["id"], artist["genres"]])
     return pd.DataFrame(data=useful_artists, columns=["artist_id", "genres"])
 
 
+@timed("loadData.load_tracks")
+@_cached_loader("tracks")
 def load_tracks(print_graphs=False) -> pd.DataFrame:
-    tracks = _load_file("tracks")
-    param_values = normalize_params(tracks, print_graphs)
-    useful_tracks = []
-    for i in range(len(tracks)):
-        useful_tracks.append(
-            [
-                tracks[i]["id"],
-                tracks[i]["popularity"],
-                tracks[i]["id_artist"],
-                tracks[i]["explicit"],
-                [
-                    param_values["duration_ms"][0][i],
-                    param_values["release_date"][0][i],
-                    param_values["danceability"][0][i],
-                    param_values["energy"][0][i],
-                    param_values["key"][0][i],
-                    param_values["loudness"][0][i],
-                    param_values["speechiness"][0][i],
-                    param_values["acousticness"][0][i],
-                    param_values["instrumentalness"][0][i],
-                    param_values["liveness"][0][i],
-                    param_values["valence"][0][i],
-                    param_values["tempo"][0][i],
-                ],
-            ]
-        )
+    return _load_tracks(FEATURES, print_graphs)
+
+
+def _load_tracks(features: List[str], print_graphs=False) -> pd.DataFrame:
+    tracks = _parse_file("tracks")
+    params = normalize_params(tracks, print_graphs, features)
     return pd.DataFrame(
-        data=useful_tracks,
-        columns=[
-            "track_id",
-            "popularity",
-            "artist_id",
-            "explicit",
-            "params",
-        ],
+        {
+            "track_id": [track["id"] for track in tracks],
+            "popularity": [track["popularity"] for track in tracks],
+            "artist_id": [track["id_artist"] for track in tracks],
+            "explicit": [track["explicit"] for track in tracks],
+            "params": params.tolist(),
+        }
+    )
+
+
+@timed("loadData.load_track_store")
+def load_track_store(
+    print_graphs=False, mmap=True, features=FEATURES
+) -> TrackFeatureStore:
+    # The store is kept as .npy files in the cache directory and opened as
+    # memory maps, so processes on one host share a single physical copy.
+    if print_graphs:
+        return _build_track_store(print_graphs, features)
+    name = "track_store"
+    if features != FEATURES:
+        digest = hashlib.sha256("-".join(features).encode()).hexdigest()
+        name += f"_{digest[:8]}"
+    return _cached_directory(
+        name,
+        ["tracks"],
+        lambda: _build_track_store(features=features),
+        lambda directory: TrackFeatureStore.load(directory, mmap),
+    )
+
+
+def _build_track_store(
+    print_graphs=False, features=FEATURES
+) -> TrackFeatureStore:
+    tracks = _parse_file("tracks")
+    return TrackFeatureStore(
+        track_ids=[track["id"] for track in tracks],
+        params=normalize_params(tracks, print_graphs, features),
+        popularity=[track["popularity"] for track in tracks],
+        artist_ids=[track["id_artist"] for track in tracks],
     )
 
 
 def histogram(data, title):
+    # matplotlib takes seconds to import and is only needed for the graphs
+    import matplotlib.pyplot as plt
+
     plt.clf()
     counts, bins = np.histogram(data, bins=100)
     plt.hist(bins[:-1], bins, weights=counts)
@@ -90,94 +288,85 @@ def histogram(data, title):
     plt.show()
 
 
-def normalize_params(tracks, print_graphs=False):
-    atributes = [
-        "duration_ms",
-        "release_date",
-        "danceability",
-        "energy",
-        "key",
-        "loudness",
-        "speechiness",
-        "acousticness",
-        "instrumentalness",
-        "liveness",
-        "valence",
-        "tempo",
-    ]
-    param_values = {}
-
-    for atr in atributes:
-        param_values[atr] = []
-
-    for track in tracks:
-        for atr in atributes:
-            if atr == "release_date":
-                param_values[atr].append(int(track[atr][:4]))
-            elif atr == "loudness":
-                param_values[atr].append(abs(track[atr]))
-            else:
-                param_values[atr].append(track[atr])
-
-    normalized_values = {}
-    for atr in atributes:
-        normalized_values[atr] = preprocessing.normalize([param_values[atr]])
+@timed("loadData.normalize_params")
+def normalize_params(
+    tracks, print_graphs=False, features=FEATURES
+) -> np.ndarray:
+    # (n_tracks, n_features) matrix with every column scaled to unit L2
+    # norm in place, filled one column at a time straight from the records.
+    # Columns are contiguous, and summed like sklearn's normalize did.
+    params = np.empty((len(tracks), len(features)), np.float64, order="F")
+    for column, atr in enumerate(features):
+        if atr == "release_date":
+            raw_values = (int(track[atr][:4]) for track in tracks)
+        else:
+            raw_values = (track[atr] for track in tracks)
+        values = params[:, column]
+        values[:] = np.fromiter(raw_values, np.float64, len(tracks))
+        if atr == "loudness":
+            np.abs(values, out=values)
+        norm = np.sqrt(np.einsum("i,i->", values, values))
+        if norm != 0:
+            values /= norm
     if print_graphs:
-        for atr in atributes:
-            histogram(normalized_values[atr], atr)
-    return normalized_values
+        for column, atr in enumerate(features):
+            histogram(params[:, column], atr)
+    return params
 
 
-def load_sessions() -> pd.DataFrame:
-    sessions = _load_file("sessions")
+@timed("loadData.load_sessions")
+@_cached_loader("sessions")
+def load_sessions(chunk_size=100_000) -> pd.DataFrame:
+    chunks = list(iter_sessions(chunk_size))
+    if not chunks:
+        return _sessions_frame([])
+    return pd.DataFrame(
+        {
+            "user_id": np.concatenate([c["user_id"] for c in chunks]),
+            "track_id": union_categoricals([c["track_id"] for c in chunks]),
+            "event": union_categoricals([c["event"] for c in chunks]),
+        }
+    )
+
+
+def iter_sessions(chunk_size=100_000) -> Iterator[pd.DataFrame]:
+    # Parses the sessions log in bounded chunks, so only one chunk of raw
+    # records is alive at a time. Chunks can be folded straight into the
+    # models' per-user aggregates without keeping the whole log.
     useful_sessions = []
-    for session in sessions:
-        if session["event_type"] != "advertisment":
+    with open(_source_path("sessions"), "r") as file:
+        for line in file:
+            session = json.loads(line)
+            if session["event_type"] == "advertisment":
+                continue
             useful_sessions.append(
-                [
+                (
                     session["user_id"],
                     session["track_id"],
                     session["event_type"],
-                ]
+                )
             )
+            if len(useful_sessions) >= chunk_size:
+                yield _sessions_frame(useful_sessions)
+                useful_sessions = []
+    if useful_sessions:
+        yield _sessions_frame(useful_sessions)
+
+
+def _sessions_frame(useful_sessions: List) -> pd.DataFrame:
+    user_ids, track_ids, events = (
+        zip(*useful_sessions) if useful_sessions else ((), (), ())
+    )
     return pd.DataFrame(
-        data=useful_sessions, columns=["user_id", "track_id", "event"]
+        {
+            "user_id": np.array(user_ids, dtype=np.int32),
+            "track_id": pd.Categorical(track_ids),
+            "event": pd.Categorical(events),
+        }
     )
 
+
+@timed("loadData.load_tracks_less")
+@_cached_loader("tracks")
 def load_tracks_less(print_graphs=False) -> pd.DataFrame:
-    tracks = _load_file("tracks")
-    param_values = normalize_params(tracks, print_graphs)
-    useful_tracks = []
-    for i in range(len(tracks)):
-        useful_tracks.append(
-            [
-                tracks[i]["id"],
-                tracks[i]["popularity"],
-                tracks[i]["id_artist"],
-                tracks[i]["explicit"],
-                [
-                    # param_values["duration_ms"][0][i],
-                    param_values["release_date"][0][i],
-                    param_values["danceability"][0][i],
-                    param_values["energy"][0][i],
-                    param_values["key"][0][i],
-                    param_values["loudness"][0][i],
-                    # param_values["speechiness"][0][i],
-                    param_values["acousticness"][0][i],
-                    # param_values["instrumentalness"][0][i],
-                    param_values["liveness"][0][i],
-                    param_values["valence"][0][i],
-                    param_values["tempo"][0][i],
-                ],
-            ]
-        )
-    return pd.DataFrame(
-        data=useful_tracks,
-        columns=[
-            "track_id",
-            "popularity",
-            "artist_id",
-            "explicit",
-            "params",
-        ],
-    )
+    return _load_tracks(LESS_FEATURES, print_graphs)
@@ -0,0 +1,46 @@
+import numpy as np
+import pandas as pd
+from typing import Dict, List, Union
+
+
+class SessionIndex:
+    # Session events sorted by user, so all events of one user form a
+    # contiguous slice found with a binary search.
+    def __init__(self, sessions: pd.DataFrame) -> None:
+        useful = np.asarray(sessions["event"], dtype=object) != "advertisment"
+        user_ids = np.asarray(sessions["user_id"], dtype=np.int64)[useful]
+        track_ids = np.asarray(sessions["track_id"], dtype=object)[useful]
+
+        order = np.argsort(user_ids, kind="stable")
+        self.track_ids = track_ids[order]
+        self.users, self.starts, counts = np.unique(
+            user_ids[order], return_index=True, return_counts=True
+        )
+        self.ends = self.starts + counts
+
+    @classmethod
+    def of(
+        cls, sessions: Union[pd.DataFrame, "SessionIndex"]
+    ) -> "SessionIndex":
+        if isinstance(sessions, cls):
+            return sessions
+        return cls(sessions)
+
+    def _tracks_of(self, user_id: int) -> np.ndarray:
+        position = np.searchsorted(self.users, user_id)
+        if position == len(self.users) or self.users[position] != user_id:
+            return self.track_ids[:0]
+        return self.track_ids[self.starts[position] : self.ends[position]]
+
+    def play_counts(self, user_id: int) -> Dict[str, int]:
+        # tracks in the order the user first played them
+        codes, track_ids = pd.factorize(
+            self._tracks_of(user_id), use_na_sentinel=False
+        )
+        return dict(zip(track_ids.tolist(), np.bincount(codes).tolist()))
+
+    def distinct_tracks(self, user_ids: List[int]) -> List[str]:
+        tracks = [self._tracks_of(user_id) for user_id in set(user_ids)]
+        if not tracks:
+            return []
+        return pd.unique(np.concatenate(tracks)).tolist()
@@ -0,0 +1,156 @@
+import hashlib
+import json
+import os
+import numpy as np
+import pandas as pd
+from typing import List, Union
+
+FORMAT_VERSION = 2
+ARRAYS = [
+    "track_ids",
+    "params",
+    "unit_params",
+    "popularity",
+    "artist_ids",
+    "sorted_rows",
+    "sorted_track_ids",
+]
+
+
+class TrackFeatureStore:
+    # Columnar view of the tracks catalogue shared by all models: one
+    # contiguous (n_tracks, n_params) float32 matrix plus parallel arrays
+    # indexed by the same row numbers. Every array is a plain numpy array,
+    # so the whole store can be saved as .npy files and memory-mapped.
+    def __init__(
+        self,
+        track_ids: List[str],
+        params: np.ndarray,
+        popularity: List[float],
+        artist_ids: List[str],
+        unit_params: np.ndarray = None,
+        sorted_rows: np.ndarray = None,
+        sorted_track_ids: np.ndarray = None,
+        fingerprint: str = None,
+    ) -> None:
+        self.track_ids = np.asarray(track_ids, dtype=str)
+        self.params = np.ascontiguousarray(params, dtype=np.float32)
+        self.popularity = np.asarray(popularity, dtype=np.float64)
+        self.artist_ids = np.asarray(artist_ids, dtype=str)
+
+        # rows scaled to unit length, so cosine similarity is a plain dot
+        if unit_params is None:
+            norms = np.linalg.norm(self.params, axis=1, keepdims=True)
+            unit_params = np.divide(
+                self.params,
+                norms,
+                out=np.zeros_like(self.params),
+                where=norms != 0,
+            )
+        self.unit_params = unit_params
+
+        # track ids in sorted order for binary-search lookups, which unlike
+        # a dict can be shared between processes through a memory map
+        if sorted_rows is None:
+            sorted_rows = np.argsort(self.track_ids, kind="stable")
+            sorted_track_ids = self.track_ids[sorted_rows]
+        self.sorted_rows = sorted_rows
+        self.sorted_track_ids = sorted_track_ids
+        self._fingerprint = fingerprint
+
+    @classmethod
+    def from_dataframe(cls, tracks: pd.DataFrame) -> "TrackFeatureStore":
+        return cls(
+            tracks["track_id"].to_numpy(),
+            np.array(tracks["params"].tolist(), dtype=np.float32),
+            tracks["popularity"].to_numpy(),
+            tracks["artist_id"].to_numpy(),
+        )
+
+    @classmethod
+    def of(
+        cls, tracks: Union[pd.DataFrame, "TrackFeatureStore"]
+    ) -> "TrackFeatureStore":
+        if isinstance(tracks, cls):
+            return tracks
+        return cls.from_dataframe(tracks)
+
+    # ==================================================== on-disk layout
+
+    def save(self, directory: str) -> None:
+        os.makedirs(directory, exist_ok=True)
+        for name in ARRAYS:
+            np.save(os.path.join(directory, f"{name}.npy"), getattr(self, name))
+        with open(os.path.join(directory, "meta.json"), "w") as file:
+            json.dump(
+                {
+                    "format_version": FORMAT_VERSION,
+                    "n_tracks": len(self),
+                    "n_params": self.number_of_params,
+                    "fingerprint": self.fingerprint,
+                },
+                file,
+            )
+
+    @classmethod
+    def load(cls, directory: str, mmap=True) -> "TrackFeatureStore":
+        with open(os.path.join(directory, "meta.json"), "r") as file:
+            meta = json.load(file)
+        if meta["format_version"] != FORMAT_VERSION:
+            raise ValueError(
+                f"Unsupported track store format: {meta['format_version']}"
+            )
+        arrays = {
+            name: np.load(
+                os.path.join(directory, f"{name}.npy"),
+                mmap_mode="r" if mmap else None,
+            )
+            for name in ARRAYS
+        }
+        return cls(**arrays, fingerprint=meta["fingerprint"])
+
+    @property
+    def fingerprint(self) -> str:
+        # Content hash of the catalogue, recorded by the model snapshots
+        # built on it. Saved with the store, so a loaded one doesn't read
+        # its arrays to get it.
+        if self._fingerprint is None:
+            digest = hashlib.sha256()
+            for name in ("track_ids", "params", "popularity", "artist_ids"):
+                array = np.ascontiguousarray(getattr(self, name))
+                digest.update(str(array.dtype).encode())
+                digest.update(array.tobytes())
+            self._fingerprint = digest.hexdigest()
+        return self._fingerprint
+
+    # ==================================================== lookups
+
+    def __len__(self) -> int:
+        return len(self.track_ids)
+
+    @property
+    def number_of_params(self) -> int:
+        return self.params.shape[1]
+
+    def lookup(self, track_ids: List[str]) -> np.ndarray:
+        # rows of the given tracks, -1 for ids outside the catalogue
+        track_ids = np.asarray(track_ids, dtype=str)
+        if len(self) == 0:
+            return np.full(len(track_ids), -1, dtype=np.int64)
+        positions = np.searchsorted(self.sorted_track_ids, track_ids)
+        positions = np.minimum(positions, len(self) - 1)
+        found = self.sorted_track_ids[positions] == track_ids
+        return np.where(found, self.sorted_rows[positions], -1).astype(np.int64)
+
+    def rows(self, track_ids: List[str]) -> np.ndarray:
+        rows = self.lookup(track_ids)
+        if (rows < 0).any():
+            missing = np.asarray(track_ids, dtype=str)[rows < 0][0]
+            raise KeyError(missing)
+        return rows
+
+    def row(self, track_id: str) -> int:
+        return int(self.rows([track_id])[0])
+
+    def vector(self, track_id: str) -> np.ndarray:
+        return self.params[self.row(track_id)]
@@ -0,0 +1,209 @@
+import argparse
+import json
+import math
+import numpy as np
+import pandas as pd
+from concurrent.futures import ThreadPoolExecutor
+from typing import Dict, List, Tuple
+
+from models.userProfileModel import UserProfileModel
+from models.popularityModel import PopularityModel
+from models.targetModel import TargetModel
+from models.ranking import MAX_BLOCK_ELEMENTS
+from data.sessionIndex import SessionIndex
+from data.trackFeatureStore import TrackFeatureStore
+from data import loadData
+
+TEST_SET = 0.3
+N = 10
+# random tracks every held-out track is ranked against
+NUMBER_OF_NEGATIVES = 100
+MODELS = ["user_profile", "popularity", "target"]
+
+# per group: rows of the held-out tracks and, for each of them, the rows
+# of the random tracks it competes with
+Candidates = Tuple[np.ndarray, np.ndarray]
+
+
+def split_sessions(
+    sessions: pd.DataFrame, test_size=TEST_SET, seed=0
+) -> Tuple[pd.DataFrame, pd.DataFrame]:
+    order = np.random.default_rng(seed).permutation(len(sessions))
+    number_of_test = int(math.ceil(len(sessions) * test_size))
+    test_rows = np.sort(order[:number_of_test])
+    train_rows = np.sort(order[number_of_test:])
+    return (
+        sessions.iloc[train_rows].reset_index(drop=True),
+        sessions.iloc[test_rows].reset_index(drop=True),
+    )
+
+
+def sample_groups(
+    user_ids: List[int], number_of_groups: int, max_group_size: int, seed=0
+) -> List[List[int]]:
+    rng = np.random.default_rng(seed)
+    user_ids = np.asarray(user_ids)
+    groups = []
+    for _ in range(number_of_groups):
+        size = min(int(rng.integers(1, max_group_size + 1)), len(user_ids))
+        groups.append(rng.choice(user_ids, size, replace=False).tolist())
+    return groups
+
+
+def build_candidates(
+    groups: List[List[int]],
+    test_sessions: SessionIndex,
+    tracks: TrackFeatureStore,
+    number_of_negatives=NUMBER_OF_NEGATIVES,
+    seed=0,
+) -> List[Candidates]:
+    # Sampled once and shared by every model, so variants are compared on
+    # the same tracks. Each group draws from its own seeded stream, which
+    # keeps the sample independent of the order groups are processed in.
+    candidates = []
+    for group_number, user_ids in enumerate(groups):
+        rows = tracks.lookup(test_sessions.distinct_tracks(user_ids))
+        rows = rows[rows >= 0]
+        rng = np.random.default_rng([seed, group_number])
+        negatives = rng.integers(
+            0, len(tracks), size=(len(rows), number_of_negatives)
+        )
+        candidates.append((rows, negatives))
+    return candidates
+
+
+def rank_positions(
+    scores: np.ndarray, rows: np.ndarray, negatives: np.ndarray
+) -> np.ndarray:
+    # position of every held-out track among its random tracks; ties go to
+    # the held-out track like in the stable sort of rank_tracks_for_users
+    return (scores[negatives] > scores[rows][:, None]).sum(axis=1)
+
+
+def _evaluate_block(
+    model, groups: List[List[int]], candidates: List[Candidates]
+) -> List[np.ndarray]:
+    return [
+        rank_positions(group_scores, rows, negatives)
+        for group_scores, (rows, negatives) in zip(
+            model.group_scores(groups), candidates
+        )
+    ]
+
+
+def evaluate(
+    model,
+    groups: List[List[int]],
+    candidates: List[Candidates],
+    number_of_songs=N,
+    n_jobs=None,
+) -> Dict:
+    # Groups are scored in blocks with one matrix product per block; the
+    # blocks run on a thread pool since numpy releases the GIL for them.
+    evaluated = [i for i, (rows, _) in enumerate(candidates) if len(rows)]
+    groups = [groups[i] for i in evaluated]
+    candidates = [candidates[i] for i in evaluated]
+
+    n_jobs = n_jobs or 1
+    block_size = max(
+        1,
+        min(
+            MAX_BLOCK_ELEMENTS // max(len(model.tracks), 1),
+            math.ceil(len(groups) / n_jobs),
+        ),
+    )
+    blocks = range(0, len(groups), block_size)
+    with ThreadPoolExecutor(n_jobs) as executor:
+        results = executor.map(
+            lambda start: _evaluate_block(
+                model,
+                groups[start : start + block_size],
+                candidates[start : start + block_size],
+            ),
+            blocks,
+        )
+        positions = [ranks for block in results for ranks in block]
+
+    ranks = np.concatenate(positions) if positions else np.empty(0)
+    if len(ranks) == 0:
+        return {"groups": len(groups), "tracks": 0}
+    return {
+        "groups": len(groups),
+        "tracks": len(ranks),
+        "average_position": float(ranks.mean()),
+        f"hit@{number_of_songs}": float((ranks < number_of_songs).mean()),
+        "mrr": float((1 / (ranks + 1)).mean()),
+        # a single relevant track per ranking, so the ideal DCG is 1
+        "ndcg": float((1 / np.log2(ranks + 2)).mean()),
+    }
+
+
+def fit_model(name: str, users, tracks, artists, sessions):
+    if name == "user_profile":
+        model = UserProfileModel()
+        model.fit(users, tracks, sessions)
+    elif name == "popularity":
+        model = PopularityModel()
+        model.fit(users, tracks, artists)
+    else:
+        model = TargetModel()
+        model.fit(users, tracks, artists, sessions)
+    return model
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Offline model evaluation")
+    parser.add_argument("--data-dir", default=loadData.DATA_DIR)
+    parser.add_argument("--models", nargs="+", choices=MODELS, default=MODELS)
+    parser.add_argument(
+        "--groups",
+        type=int,
+        default=0,
+        help="number of random groups, 0 evaluates every user on their own",
+    )
+    parser.add_argument("--max-group-size", type=int, default=3)
+    parser.add_argument("--negatives", type=int, default=NUMBER_OF_NEGATIVES)
+    parser.add_argument("--test-size", type=float, default=TEST_SET)
+    parser.add_argument("-n", "--number-of-songs", type=int, default=N)
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--jobs", type=int, default=None)
+    parser.add_argument("--json", help="write the results to this file")
+    args = parser.parse_args()
+
+    loadData.DATA_DIR = args.data_dir
+    users = loadData.load_users()
+    tracks = loadData.load_track_store()
+    artists = loadData.load_artists()
+    sessions_train, sessions_test = split_sessions(
+        loadData.load_sessions(), args.test_size, args.seed
+    )
+    test_sessions = SessionIndex(sessions_test)
+
+    test_users = np.unique(sessions_test["user_id"]).tolist()
+    if args.groups:
+        groups = sample_groups(
+            test_users, args.groups, args.max_group_size, args.seed
+        )
+    else:
+        groups = [[user_id] for user_id in test_users]
+    candidates = build_candidates(
+        groups, test_sessions, tracks, args.negatives, args.seed
+    )
+
+    results = {}
+    for name in args.models:
+        model = fit_model(name, users, tracks, artists, sessions_train)
+        results[name] = evaluate(
+            model, groups, candidates, args.number_of_songs, args.jobs
+        )
+        print(f"{f' {name} ':=^52}")
+        for metric, value in results[name].items():
+            print(f"{metric}: {round(value, 4)}")
+
+    if args.json:
+        with open(args.json, "w") as file:
+            json.dump(results, file, indent=2)
+
+
+if __name__ == "__main__":
+    main()
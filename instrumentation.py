@@ -0,0 +1,201 @@
+import atexit
+import json
+import os
+import re
+import threading
+import time
+import numpy as np
+from collections import deque
+from functools import wraps
+from typing import Callable, Dict
+
+# set to a file path (.prom for Prometheus text, anything else for JSON)
+# to record metrics from startup and write them when the process exits
+ENV_VARIABLE = "PLAYLIST_METRICS"
+# recent samples per histogram used for the percentiles
+MAX_SAMPLES = 10_000
+QUANTILES = [0.5, 0.9, 0.99]
+PROMETHEUS_PREFIX = "playlist_"
+
+_enabled = False
+_lock = threading.Lock()
+_counters: Dict[str, float] = {}
+_histograms: Dict[str, "Histogram"] = {}
+
+
+class Histogram:
+    # Count and sum of every observation plus a window of the most recent
+    # ones, from which the percentiles are computed on export.
+    def __init__(self, max_samples=MAX_SAMPLES) -> None:
+        self.count = 0
+        self.sum = 0.0
+        self.max = 0.0
+        self.samples = deque(maxlen=max_samples)
+
+    def observe(self, value: float) -> None:
+        self.count += 1
+        self.sum += value
+        self.max = max(self.max, value)
+        self.samples.append(value)
+
+    def summary(self) -> Dict[str, float]:
+        summary = {
+            "count": self.count,
+            "sum": self.sum,
+            "mean": self.sum / self.count if self.count else 0.0,
+            "max": self.max,
+        }
+        samples = np.fromiter(self.samples, dtype=np.float64)
+        for quantile in QUANTILES:
+            summary[f"p{round(quantile * 100)}"] = (
+                float(np.quantile(samples, quantile)) if len(samples) else 0.0
+            )
+        return summary
+
+
+class _Stage:
+    __slots__ = ("name", "start")
+
+    def __init__(self, name: str) -> None:
+        self.name = name
+
+    def __enter__(self) -> "_Stage":
+        self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc_info) -> None:
+        observe(self.name, time.perf_counter() - self.start)
+
+
+class _NoStage:
+    __slots__ = ()
+
+    def __enter__(self) -> None:
+        return None
+
+    def __exit__(self, *exc_info) -> None:
+        return None
+
+
+_no_stage = _NoStage()
+
+
+# ==================================================== switch
+
+
+def enable(path: str = None) -> None:
+    # with a path the metrics are written there when the process exits
+    global _enabled
+    _enabled = True
+    if path:
+        atexit.register(write, path)
+
+
+def disable() -> None:
+    global _enabled
+    _enabled = False
+
+
+def is_enabled() -> bool:
+    return _enabled
+
+
+def reset() -> None:
+    with _lock:
+        _counters.clear()
+        _histograms.clear()
+
+
+# ==================================================== recording
+
+
+def stage(name: str):
+    # Times the block into the histogram `name`, in seconds. While
+    # disabled it hands out one shared no-op context, so stages can stay
+    # in the hot paths.
+    if not _enabled:
+        return _no_stage
+    return _Stage(name)
+
+
+def timed(name: str = None) -> Callable:
+    def decorator(function: Callable) -> Callable:
+        stage_name = name or f"{function.__module__}.{function.__qualname__}"
+
+        @wraps(function)
+        def wrapper(*args, **kwargs):
+            if not _enabled:
+                return function(*args, **kwargs)
+            with _Stage(stage_name):
+                return function(*args, **kwargs)
+
+        return wrapper
+
+    return decorator
+
+
+def count(name: str, value=1) -> None:
+    if not _enabled:
+        return
+    with _lock:
+        _counters[name] = _counters.get(name, 0) + value
+
+
+def observe(name: str, value: float) -> None:
+    if not _enabled:
+        return
+    with _lock:
+        histogram = _histograms.get(name)
+        if histogram is None:
+            histogram = _histograms[name] = Histogram()
+        histogram.observe(value)
+
+
+# ==================================================== export
+
+
+def snapshot() -> Dict:
+    with _lock:
+        return {
+            "counters": dict(_counters),
+            "histograms": {
+                name: histogram.summary()
+                for name, histogram in sorted(_histograms.items())
+            },
+        }
+
+
+def _metric_name(name: str) -> str:
+    return PROMETHEUS_PREFIX + re.sub(r"[^a-zA-Z0-9_]", "_", name)
+
+
+def prometheus_text() -> str:
+    metrics = snapshot()
+    lines = []
+    for name, value in sorted(metrics["counters"].items()):
+        metric = _metric_name(name) + "_total"
+        lines.append(f"# TYPE {metric} counter")
+        lines.append(f"{metric} {value}")
+    for name, summary in metrics["histograms"].items():
+        metric = _metric_name(name) + "_seconds"
+        lines.append(f"# TYPE {metric} summary")
+        for quantile in QUANTILES:
+            value = summary[f"p{round(quantile * 100)}"]
+            lines.append(f'{metric}{{quantile="{quantile}"}} {value}')
+        lines.append(f"{metric}_sum {summary['sum']}")
+        lines.append(f"{metric}_count {summary['count']}")
+    return "\n".join(lines) + "\n"
+
+
+def write(path: str) -> None:
+    tmp_path = f"{path}.{os.getpid()}.tmp"
+    with open(tmp_path, "w") as file:
+        if path.endswith(".prom"):
+            file.write(prometheus_text())
+        else:
+            json.dump(snapshot(), file, indent=2)
+    os.replace(tmp_path, path)
+
+
+if os.environ.get(ENV_VARIABLE):
+    enable(os.environ[ENV_VARIABLE])
@@ -0,0 +1,92 @@
+import numpy as np
+from typing import Dict, Tuple
+
+from models.ranking import unit_rows, top_n
+
+# rows assigned to centroids at once while clustering
+ASSIGN_CHUNK = 65536
+
+
+class IVFIndex:
+    # Inverted-file index for approximate cosine retrieval. Track vectors
+    # are clustered with spherical k-means; a query only scores the tracks
+    # of the n_probe partitions whose centroids are closest to it.
+    def __init__(
+        self,
+        track_units: np.ndarray,
+        n_partitions: int,
+        n_iterations=10,
+        seed=0,
+    ) -> None:
+        self.track_units = track_units
+        n_partitions = max(1, min(n_partitions, len(track_units)))
+        rng = np.random.default_rng(seed)
+        self.centroids = np.array(
+            track_units[rng.choice(len(track_units), n_partitions, False)]
+        )
+        for _ in range(n_iterations):
+            assignment = self._assign()
+            sums = np.zeros_like(self.centroids, dtype=np.float64)
+            for param in range(track_units.shape[1]):
+                sums[:, param] = np.bincount(
+                    assignment,
+                    weights=track_units[:, param],
+                    minlength=n_partitions,
+                )
+            # empty partitions keep their previous centroid
+            empty = ~sums.any(axis=1)
+            sums[empty] = self.centroids[empty]
+            self.centroids = unit_rows(sums).astype(np.float32)
+
+        assignment = self._assign()
+        self.rows = np.argsort(assignment, kind="stable")
+        self.offsets = np.searchsorted(
+            assignment[self.rows], np.arange(n_partitions + 1)
+        )
+
+    def __len__(self) -> int:
+        return len(self.centroids)
+
+    def arrays(self) -> Dict[str, np.ndarray]:
+        return {
+            "centroids": self.centroids,
+            "rows": self.rows,
+            "offsets": self.offsets,
+        }
+
+    @classmethod
+    def from_arrays(
+        cls, track_units: np.ndarray, arrays: Dict[str, np.ndarray]
+    ) -> "IVFIndex":
+        ann_index = cls.__new__(cls)
+        ann_index.track_units = track_units
+        ann_index.centroids = arrays["centroids"]
+        ann_index.rows = arrays["rows"]
+        ann_index.offsets = arrays["offsets"]
+        return ann_index
+
+    def _assign(self) -> np.ndarray:
+        assignment = np.empty(len(self.track_units), dtype=np.int64)
+        for start in range(0, len(self.track_units), ASSIGN_CHUNK):
+            chunk = self.track_units[start : start + ASSIGN_CHUNK]
+            assignment[start : start + ASSIGN_CHUNK] = np.argmax(
+                chunk @ self.centroids.T, axis=1
+            )
+        return assignment
+
+    def search(
+        self, query_unit: np.ndarray, number_of_songs: int, n_probe: int
+    ) -> Tuple[np.ndarray, np.ndarray]:
+        # rows and scores of the best tracks among the probed partitions
+        partitions = top_n(self.centroids @ query_unit, n_probe)
+        candidates = np.sort(
+            np.concatenate(
+                [
+                    self.rows[self.offsets[p] : self.offsets[p + 1]]
+                    for p in partitions
+                ]
+            )
+        )
+        scores = self.track_units[candidates] @ query_unit
+        best = top_n(scores, number_of_songs)
+        return candidates[best], scores[best]
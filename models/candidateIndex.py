@@ -0,0 +1,153 @@
+import numpy as np
+from scipy import sparse
+from typing import Dict, Tuple
+
+from models.ranking import top_n
+from models.genreIndex import (
+    GenreIndex,
+    NO_GENRE_LEVEL,
+    csr_arrays,
+    csr_from_arrays,
+)
+
+ARRAYS = ["rows", "offsets", "keys", "popularity", "popularity_range"]
+
+
+class CandidateIndex:
+    # Tracks grouped by the genres of their artist, each group ordered by
+    # popularity. Within a group the popularity term of the score,
+    # 100 * bonus + popularity * (1 - bonus), is linear in popularity, so
+    # the tracks whose term reaches a threshold are a prefix of the group,
+    # or a suffix when the genre bonus is above 1. They are found by binary
+    # search, without touching the rest of the catalogue.
+    def __init__(self, genre_index: GenreIndex, popularity: np.ndarray) -> None:
+        incidence = genre_index.incidence.tocsr()
+        incidence.sort_indices()
+        lengths = np.diff(incidence.indptr)
+        genre_sets = np.full(
+            (len(lengths), int(lengths.max(initial=0))), -1, dtype=np.int64
+        )
+        positions = np.arange(incidence.nnz)
+        positions -= np.repeat(incidence.indptr[:-1], lengths)
+        genre_sets[np.repeat(np.arange(len(lengths)), lengths), positions] = (
+            incidence.indices
+        )
+        unique_sets, group_of = np.unique(
+            genre_sets, axis=0, return_inverse=True
+        )
+        group_of = group_of.ravel()
+        group_rows, genre_columns = np.nonzero(unique_sets >= 0)
+        self.groups = sparse.csr_matrix(
+            (
+                np.ones(len(group_rows)),
+                (group_rows, unique_sets[group_rows, genre_columns]),
+            ),
+            shape=(len(unique_sets), incidence.shape[1]),
+        )
+
+        popularity = np.asarray(popularity, dtype=np.float64)
+        self.rows = np.lexsort(
+            (np.arange(len(popularity)), -popularity, group_of)
+        )
+        self.offsets = np.searchsorted(
+            group_of[self.rows], np.arange(len(unique_sets) + 1)
+        )
+        self.popularity = popularity[self.rows]
+        # one ascending key for all groups, so every group is searched at
+        # once: the group number scaled past the popularity range, plus the
+        # distance from the highest popularity
+        self.popularity_range = np.array(
+            [popularity.min(initial=0), popularity.max(initial=0)]
+        )
+        self.keys = group_of[self.rows] * self._span() + (
+            self.popularity_range[1] - self.popularity
+        )
+
+    def arrays(self) -> Dict[str, np.ndarray]:
+        return {
+            **csr_arrays(self.groups),
+            **{name: getattr(self, name) for name in ARRAYS},
+        }
+
+    @classmethod
+    def from_arrays(cls, arrays: Dict[str, np.ndarray]) -> "CandidateIndex":
+        candidate_index = cls.__new__(cls)
+        candidate_index.groups = csr_from_arrays(arrays)
+        for name in ARRAYS:
+            setattr(candidate_index, name, arrays[name])
+        return candidate_index
+
+    def _span(self) -> float:
+        return self.popularity_range[1] - self.popularity_range[0] + 1
+
+    def _levels(self, genre_counts: np.ndarray) -> np.ndarray:
+        # popularity level of the tracks of every group
+        return NO_GENRE_LEVEL + self.groups @ genre_counts
+
+    def first_rows(
+        self,
+        genre_counts: np.ndarray,
+        genre_coefficient: float,
+        number_of_tracks: int,
+    ) -> np.ndarray:
+        # the best track of the groups with the best popularity term, at
+        # the most popular end of a group below a bonus of 1 and at the
+        # least popular one above it
+        bonuses = self._levels(genre_counts) * genre_coefficient
+        ends = np.where(bonuses <= 1, self.offsets[:-1], self.offsets[1:] - 1)
+        popularity = self.popularity[ends]
+        best = top_n(
+            popularity + (100 - popularity) * bonuses, number_of_tracks
+        )
+        return np.sort(self.rows[ends[best]])
+
+    def rows_above(
+        self,
+        genre_counts: np.ndarray,
+        genre_coefficient: float,
+        min_popularity: float,
+    ) -> Tuple[np.ndarray, np.ndarray]:
+        # rows, in catalogue order, and popularity terms of every track
+        # whose term is at least min_popularity
+        levels = self._levels(genre_counts)
+        bonuses = levels * genre_coefficient
+        # popularity at which the term reaches min_popularity; from there
+        # up below a bonus of 1, from there down above it
+        with np.errstate(divide="ignore", invalid="ignore"):
+            limits = (min_popularity - 100 * bonuses) / (1 - bonuses)
+        limits[bonuses == 1] = -np.inf if min_popularity <= 100 else np.inf
+        # a group is taken whole or skipped when the limit is past one of
+        # its ends; only the others are searched
+        most = self.popularity[self.offsets[:-1]]
+        least = self.popularity[self.offsets[1:] - 1]
+        starts = self.offsets[:-1].copy()
+        ends = self.offsets[1:].copy()
+        group_keys = np.arange(len(levels)) * self._span()
+        group_keys += self.popularity_range[1]
+        increasing = bonuses <= 1
+        skipped = increasing & (limits > most)
+        ends[skipped] = starts[skipped]
+        partial = np.flatnonzero(increasing & (limits > least) & ~skipped)
+        ends[partial] = np.searchsorted(
+            self.keys, group_keys[partial] - limits[partial], side="right"
+        )
+        decreasing = ~increasing
+        skipped = decreasing & (limits < least)
+        starts[skipped] = ends[skipped]
+        partial = np.flatnonzero(decreasing & (limits < most) & ~skipped)
+        starts[partial] = np.searchsorted(
+            self.keys, group_keys[partial] - limits[partial], side="left"
+        )
+        lengths = ends - starts
+        positions = np.repeat(starts - np.cumsum(lengths) + lengths, lengths)
+        positions += np.arange(len(positions))
+
+        # the expression of GenreIndex.popularity_scores, so the terms are
+        # exactly those of the exhaustive ranking
+        popularity = self.popularity[positions]
+        popularities = popularity + (
+            (100 - popularity) * np.repeat(levels, lengths) * genre_coefficient
+        )
+        rows = self.rows[positions]
+        order = np.argsort(rows, kind="stable")
+        return rows[order], popularities[order]
@@ -0,0 +1,113 @@
+import numpy as np
+import pandas as pd
+from scipy import sparse
+from typing import Dict, List, Iterable
+
+from data.trackFeatureStore import TrackFeatureStore
+
+# popularity level of a track sharing no genre with the group
+NO_GENRE_LEVEL = -0.1
+
+
+class GenreIndex:
+    # Sparse tracks x genres incidence matrix; a track has the genres of
+    # its artist. Scoring a group is one sparse mat-vec with the group's
+    # genre-count vector.
+    def __init__(
+        self,
+        tracks: TrackFeatureStore,
+        genres_for_artist: Dict[str, List[str]],
+        extra_genres: Iterable[str] = (),
+    ) -> None:
+        self.genres: Dict[str, int] = {}
+        for genres in genres_for_artist.values():
+            for genre in genres:
+                self.genres.setdefault(genre, len(self.genres))
+        for genre in sorted(extra_genres):
+            self.genres.setdefault(genre, len(self.genres))
+
+        artist_rows, genre_columns = [], []
+        for artist_row, genres in enumerate(genres_for_artist.values()):
+            columns = {self.genres[genre] for genre in genres}
+            artist_rows.extend([artist_row] * len(columns))
+            genre_columns.extend(columns)
+        # the extra last row stands for artists missing from the mapping
+        artists_incidence = sparse.csr_matrix(
+            (np.ones(len(artist_rows)), (artist_rows, genre_columns)),
+            shape=(len(genres_for_artist) + 1, len(self.genres)),
+        )
+        artist_row_of = {
+            artist_id: row for row, artist_id in enumerate(genres_for_artist)
+        }
+        track_artist_rows = (
+            pd.Series(tracks.artist_ids)
+            .map(artist_row_of)
+            .fillna(len(genres_for_artist))
+            .to_numpy(dtype=np.int64)
+        )
+        self.incidence = artists_incidence[track_artist_rows]
+
+    def arrays(self) -> Dict[str, np.ndarray]:
+        return {
+            "genres": np.array(list(self.genres), dtype=str),
+            **csr_arrays(self.incidence),
+        }
+
+    @classmethod
+    def from_arrays(cls, arrays: Dict[str, np.ndarray]) -> "GenreIndex":
+        genre_index = cls.__new__(cls)
+        genre_index.genres = {
+            genre: column
+            for column, genre in enumerate(arrays["genres"].tolist())
+        }
+        genre_index.incidence = csr_from_arrays(arrays)
+        return genre_index
+
+    def popularity_scores(
+        self,
+        genre_counts: np.ndarray,
+        popularity: np.ndarray,
+        genre_coefficient: float,
+        rows: np.ndarray = None,
+    ) -> np.ndarray:
+        incidence = self.incidence if rows is None else self.incidence[rows]
+        popularity_level = NO_GENRE_LEVEL + incidence @ genre_counts
+        return popularity + (
+            (100 - popularity) * popularity_level * genre_coefficient
+        )
+
+    def popularity_scores_matrix(
+        self,
+        genre_counts: sparse.csr_matrix,
+        popularity: np.ndarray,
+        genre_coefficients: np.ndarray,
+    ) -> np.ndarray:
+        # scores of every track for a block of groups, one row per group
+        popularity_level = (
+            NO_GENRE_LEVEL + (self.incidence @ genre_counts.T).toarray()
+        )
+        return (
+            popularity[:, None]
+            + (
+                (100 - popularity)[:, None]
+                * popularity_level
+                * genre_coefficients[None, :]
+            )
+        ).T
+
+
+def csr_arrays(matrix: sparse.csr_matrix) -> Dict[str, np.ndarray]:
+    matrix = matrix.tocsr()
+    return {
+        "data": matrix.data,
+        "indices": matrix.indices,
+        "indptr": matrix.indptr,
+        "shape": np.array(matrix.shape, dtype=np.int64),
+    }
+
+
+def csr_from_arrays(arrays: Dict[str, np.ndarray]) -> sparse.csr_matrix:
+    return sparse.csr_matrix(
+        (arrays["data"], arrays["indices"], arrays["indptr"]),
+        shape=tuple(arrays["shape"].tolist()),
+    )
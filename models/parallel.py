@@ -0,0 +1,197 @@
+import multiprocessing
+import os
+import numpy as np
+from concurrent.futures import ProcessPoolExecutor
+from multiprocessing import shared_memory
+from scipy import sparse
+from typing import Dict, List, Tuple
+
+from data.trackFeatureStore import TrackFeatureStore
+from models.genreIndex import GenreIndex, NO_GENRE_LEVEL
+from models.ranking import top_n, group_blocks
+
+# arrays attached in a worker process, by name
+_worker_arrays: Dict[str, np.ndarray] = {}
+_worker_memory: List[shared_memory.SharedMemory] = []
+
+
+def _attach(
+    specs: Dict[str, Tuple[str, Tuple, str]], incidence_shape: Tuple
+) -> None:
+    for name, (memory_name, shape, dtype) in specs.items():
+        memory = shared_memory.SharedMemory(name=memory_name)
+        _worker_memory.append(memory)
+        _worker_arrays[name] = np.ndarray(
+            shape, dtype=np.dtype(dtype), buffer=memory.buf
+        )
+    if incidence_shape is not None:
+        _worker_arrays["incidence"] = sparse.csr_matrix(
+            (
+                _worker_arrays["incidence_data"],
+                _worker_arrays["incidence_indices"],
+                _worker_arrays["incidence_indptr"],
+            ),
+            shape=incidence_shape,
+        )
+
+
+def _score_shard(
+    start: int,
+    end: int,
+    number_of_songs: int,
+    vectors: np.ndarray,
+    genre_counts: np.ndarray,
+    genre_coefficients: np.ndarray,
+) -> Tuple[np.ndarray, np.ndarray]:
+    # local top N of every group within rows [start, end) of the catalogue
+    if vectors is not None:
+        number_of_groups = len(vectors)
+    else:
+        number_of_groups = len(genre_counts)
+    scores = np.zeros((number_of_groups, end - start), dtype=np.float64)
+    if vectors is not None:
+        distances = vectors @ _worker_arrays["unit_params"][start:end].T
+        scores += distances if genre_counts is None else distances * 100
+    if genre_counts is not None:
+        popularity = _worker_arrays["popularity"][start:end]
+        incidence = _worker_arrays["incidence"][start:end]
+        popularity_level = NO_GENRE_LEVEL + incidence @ genre_counts.T
+        scores += (
+            popularity[:, None]
+            + (
+                (100 - popularity)[:, None]
+                * popularity_level
+                * genre_coefficients[None, :]
+            )
+        ).T
+
+    shape = (number_of_groups, min(number_of_songs, end - start))
+    rows = np.empty(shape, dtype=np.int64)
+    best_scores = np.empty(shape, dtype=np.float64)
+    for group, group_scores in enumerate(scores):
+        best = top_n(group_scores, number_of_songs)
+        rows[group] = best + start
+        best_scores[group] = group_scores[best]
+    return rows, best_scores
+
+
+class ParallelScorer:
+    # Opt-in multi-process scoring. The catalogue arrays are copied once into
+    # shared memory and every worker maps them by name, so a task only
+    # carries the group queries and the bounds of its shard. Each worker
+    # returns a local top N per group and the results are merged here.
+    def __init__(
+        self,
+        tracks: TrackFeatureStore,
+        genre_index: GenreIndex = None,
+        n_workers: int = None,
+    ) -> None:
+        self.n_workers = n_workers or os.cpu_count() or 1
+        self.number_of_tracks = len(tracks)
+        arrays = {
+            "unit_params": tracks.unit_params,
+            "popularity": tracks.popularity,
+        }
+        incidence_shape = None
+        if genre_index is not None:
+            incidence = genre_index.incidence.tocsr()
+            incidence_shape = incidence.shape
+            arrays["incidence_data"] = incidence.data
+            arrays["incidence_indices"] = incidence.indices
+            arrays["incidence_indptr"] = incidence.indptr
+
+        self.memory: List[shared_memory.SharedMemory] = []
+        specs = {}
+        for name, array in arrays.items():
+            array = np.ascontiguousarray(array)
+            memory = shared_memory.SharedMemory(
+                create=True, size=max(array.nbytes, 1)
+            )
+            np.ndarray(array.shape, array.dtype, buffer=memory.buf)[:] = array
+            self.memory.append(memory)
+            specs[name] = (memory.name, array.shape, array.dtype.str)
+
+        self.pool = ProcessPoolExecutor(
+            self.n_workers,
+            mp_context=multiprocessing.get_context("spawn"),
+            initializer=_attach,
+            initargs=(specs, incidence_shape),
+        )
+        bounds = np.linspace(
+            0, self.number_of_tracks, self.n_workers + 1, dtype=np.int64
+        )
+        self.shards = [
+            (int(start), int(end))
+            for start, end in zip(bounds[:-1], bounds[1:])
+            if end > start
+        ]
+
+    def top_n(
+        self,
+        number_of_songs: int,
+        vectors: np.ndarray = None,
+        genre_counts: np.ndarray = None,
+        genre_coefficients: np.ndarray = None,
+    ) -> List[np.ndarray]:
+        # vectors alone score cosine similarity, genre counts alone score
+        # popularity and both together the combined target score
+        number_of_groups = len(vectors if vectors is not None else genre_counts)
+        shard_size = max(end - start for start, end in self.shards)
+        playlists = []
+        for block in group_blocks(number_of_groups, shard_size):
+            playlists.extend(
+                self._top_n_block(
+                    number_of_songs,
+                    None if vectors is None else vectors[block],
+                    None if genre_counts is None else genre_counts[block],
+                    (
+                        None
+                        if genre_coefficients is None
+                        else genre_coefficients[block]
+                    ),
+                )
+            )
+        return playlists
+
+    def _top_n_block(
+        self,
+        number_of_songs: int,
+        vectors: np.ndarray,
+        genre_counts: np.ndarray,
+        genre_coefficients: np.ndarray,
+    ) -> List[np.ndarray]:
+        futures = [
+            self.pool.submit(
+                _score_shard,
+                start,
+                end,
+                number_of_songs,
+                vectors,
+                genre_counts,
+                genre_coefficients,
+            )
+            for start, end in self.shards
+        ]
+        results = [future.result() for future in futures]
+        rows = np.concatenate([shard_rows for shard_rows, _ in results], axis=1)
+        scores = np.concatenate(
+            [shard_scores for _, shard_scores in results], 1
+        )
+        playlists = []
+        for group_rows, group_scores in zip(rows, scores):
+            order = np.lexsort((group_rows, -group_scores))[:number_of_songs]
+            playlists.append(group_rows[order])
+        return playlists
+
+    def close(self) -> None:
+        self.pool.shutdown()
+        for memory in self.memory:
+            memory.close()
+            memory.unlink()
+        self.memory = []
+
+    def __enter__(self) -> "ParallelScorer":
+        return self
+
+    def __exit__(self, *exc_info) -> None:
+        self.close()
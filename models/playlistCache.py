@@ -0,0 +1,129 @@
+import threading
+import time
+from collections import OrderedDict
+from typing import Callable, Dict, Iterable, List, Set, Tuple
+
+default_max_entries = 1024
+# seconds a playlist is served from the cache, None keeps it until evicted
+default_ttl = 600.0
+
+CacheKey = Tuple[str, Tuple[int, ...], int]
+
+
+class PlaylistCache:
+    # LRU cache of finished playlists keyed by model type, the sorted set
+    # of users and the playlist length. Every user keeps the keys of the
+    # groups they are in, so new events of one member drop exactly the
+    # playlists that depended on their history.
+    def __init__(
+        self, max_entries=default_max_entries, ttl=default_ttl, clock=None
+    ) -> None:
+        self.max_entries = max_entries
+        self.ttl = ttl
+        self.clock = clock or time.monotonic
+        self.entries: "OrderedDict[CacheKey, Tuple[float, List[str]]]" = (
+            OrderedDict()
+        )
+        self.keys_by_user: Dict[int, Set[CacheKey]] = {}
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.invalidations = 0
+        self._lock = threading.Lock()
+
+    @staticmethod
+    def key(
+        model_type: str, user_ids: Iterable[int], number_of_songs: int
+    ) -> CacheKey:
+        return (model_type, tuple(sorted(set(user_ids))), number_of_songs)
+
+    def get(
+        self, model_type: str, user_ids: Iterable[int], number_of_songs: int
+    ) -> List[str]:
+        key = self.key(model_type, user_ids, number_of_songs)
+        with self._lock:
+            entry = self.entries.get(key)
+            if entry is not None and self._expired(entry):
+                self._remove(key)
+                self.evictions += 1
+                entry = None
+            if entry is None:
+                self.misses += 1
+                return None
+            self.entries.move_to_end(key)
+            self.hits += 1
+            return list(entry[1])
+
+    def put(
+        self,
+        model_type: str,
+        user_ids: Iterable[int],
+        number_of_songs: int,
+        playlist: List[str],
+    ) -> None:
+        key = self.key(model_type, user_ids, number_of_songs)
+        with self._lock:
+            if key in self.entries:
+                self._remove(key)
+            self.entries[key] = (self.clock(), list(playlist))
+            for user_id in key[1]:
+                self.keys_by_user.setdefault(user_id, set()).add(key)
+            while len(self.entries) > self.max_entries:
+                self._remove(next(iter(self.entries)))
+                self.evictions += 1
+
+    def get_or_compute(
+        self,
+        model_type: str,
+        user_ids: Iterable[int],
+        number_of_songs: int,
+        compute: Callable[[], List[str]],
+    ) -> List[str]:
+        playlist = self.get(model_type, user_ids, number_of_songs)
+        if playlist is None:
+            playlist = compute()
+            self.put(model_type, user_ids, number_of_songs, playlist)
+        return playlist
+
+    def invalidate_user(self, user_id: int) -> int:
+        # drops every cached playlist of a group the user belongs to
+        with self._lock:
+            keys = list(self.keys_by_user.get(user_id, ()))
+            for key in keys:
+                self._remove(key)
+            self.invalidations += len(keys)
+            return len(keys)
+
+    def invalidate_users(self, user_ids: Iterable[int]) -> int:
+        return sum(self.invalidate_user(user_id) for user_id in set(user_ids))
+
+    def clear(self) -> None:
+        with self._lock:
+            self.invalidations += len(self.entries)
+            self.entries.clear()
+            self.keys_by_user.clear()
+
+    def stats(self) -> Dict[str, int]:
+        with self._lock:
+            return {
+                "entries": len(self.entries),
+                "hits": self.hits,
+                "misses": self.misses,
+                "evictions": self.evictions,
+                "invalidations": self.invalidations,
+            }
+
+    def __len__(self) -> int:
+        return len(self.entries)
+
+    def _expired(self, entry: Tuple[float, List[str]]) -> bool:
+        return self.ttl is not None and self.clock() - entry[0] > self.ttl
+
+    def _remove(self, key: CacheKey) -> None:
+        del self.entries[key]
+        for user_id in key[1]:
+            keys = self.keys_by_user.get(user_id)
+            if keys is not None:
+                keys.discard(key)
+                if not keys:
+                    del self.keys_by_user[user_id]
@@ -1,32 +1,77 @@
 import pandas as pd
 import numpy as np
-from typing import List, Dict, Tuple
-import copy
+from typing import List, Dict, Tuple, Union
+
+from data.trackFeatureStore import TrackFeatureStore
+from models.genreIndex import GenreIndex
+from models.userGenres import UserGenres
+from models.parallel import ParallelScorer
+from models.snapshot import save_snapshot, load_snapshot
+from models.ranking import top_n, rank_all, group_blocks
+from instrumentation import stage, timed
 
 
 class PopularityModel:
     def __init__(self, genre_coefficient=0.5):
         self.genre_coefficient = genre_coefficient
+        self.parallel = None
 
+    @timed("popularity.fit")
     def fit(
         self,
         users: pd.DataFrame,
-        tracks: pd.DataFrame,
+        tracks: Union[pd.DataFrame, TrackFeatureStore],
         artists: pd.DataFrame,
     ) -> None:
         self.users = users
-        self.tracks = tracks
+        self.tracks = TrackFeatureStore.of(tracks)
         self.artists = artists
 
-        self.users_genres = self._get_all_user_genres()
-        self.artists_genres = self._get_genres_for_artist()
-        self.tracks_genres = self._get_genres_for_tracks()
+        with stage("popularity.fit.genre_index"):
+            self.users_genres = self._get_all_user_genres()
+            self.artists_genres = self._get_genres_for_artist()
+            self.genre_index = GenreIndex(
+                self.tracks, self.artists_genres, self.users_genres
+            )
+        with stage("popularity.fit.user_genres"):
+            self.user_genres = UserGenres(self.users, self.genre_index)
+
+    def save(self, path: str, source_hash: str = None) -> None:
+        save_snapshot(
+            path,
+            "popularity",
+            {"genre_coefficient": self.genre_coefficient},
+            self.tracks,
+            {
+                "genre_index": self.genre_index.arrays(),
+                "user_genres": self.user_genres.arrays(),
+            },
+            source_hash,
+        )
+
+    @classmethod
+    def load(
+        cls,
+        path: str,
+        tracks: TrackFeatureStore,
+        mmap=True,
+        source_hash: str = None,
+    ) -> "PopularityModel":
+        # the track store is not part of the snapshot, it is shared
+        meta, components = load_snapshot(
+            path, "popularity", tracks, mmap, source_hash
+        )
+        model = cls(**meta["params"])
+        # the raw frames passed to fit are not part of the snapshot
+        model.users = None
+        model.artists = None
+        model.tracks = tracks
+        model.genre_index = GenreIndex.from_arrays(components["genre_index"])
+        model.user_genres = UserGenres.from_arrays(components["user_genres"])
+        return model
 
     def _get_all_user_genres(self) -> List[str]:
-        all_genres = set()
-        for i in range(len(self.users)):
-            all_genres.update(self.users.loc[i, "favourite_genres"])
-        return all_genres
+        return set(self.users["favourite_genres"].explode().dropna())
 
     def _get_genres_for_artist(self) -> Dict:
         genres_for_artist = {}
@@ -36,96 +81,132 @@ class PopularityModel:
             ] = self.artists.loc[i, "genres"]
         return genres_for_artist
 
-    def _get_genres_for_tracks(self) -> Dict:
-        tracks_with_genres = {}
-        for i in range(len(self.tracks)):
-            tracks_with_genres[self.tracks.loc[i, "track_id"]] = {
-                "popularity": self.tracks.loc[i, "popularity"],
-                "genres": self.artists_genres[self.tracks.loc[i, "artist_id"]],
-            }
-        return tracks_with_genres
-
-    def _aggregate_users_genres(self, user_ids: List[int]) -> Dict:
-        users_genres = {}
-        for user_id in user_ids:
-            for genre in self._genres_for_user(user_id):
-                if genre not in users_genres:
-                    users_genres[f"{genre}"] = 1
-                else:
-                    users_genres[f"{genre}"] += 1
-        return users_genres
+    def _aggregate_users_genres(self, user_ids: List[int]) -> np.ndarray:
+        return self.user_genres.genre_counts(user_ids)
 
     def _genres_for_user(self, user_id: int) -> List[str]:
-        for i in range(len(self.users)):
-            if self.users.loc[i, "user_id"] == user_id:
-                return self.users.loc[i, "favourite_genres"]
-
-    def _calculate_popularity(
-        self, track_id: str, users_genres: List[Tuple[str, int]]
-    ) -> float:
-        track_dict = self.tracks_genres[track_id]
-        popularity_level = -0.1
-        for genre, n_of_occurrences in list(users_genres.items()):
-            if genre in track_dict["genres"]:
-                popularity_level += n_of_occurrences
-        return track_dict["popularity"] + (
-            (
-                (100 - track_dict["popularity"])
-                * popularity_level
-                * self.genre_coefficient
-            )
-        )
+        return self.user_genres.genres_of(user_id, self.genre_index)
 
     # ==================================================== public methods
 
+    def unknown_users(self, user_ids: List[int]) -> List[int]:
+        # ids that were not in the users the model was fitted on
+        return self.user_genres.unknown(user_ids)
+
+    def enable_parallel(self, n_workers=None) -> None:
+        self.disable_parallel()
+        self.parallel = ParallelScorer(
+            self.tracks, self.genre_index, n_workers=n_workers
+        )
+
+    def disable_parallel(self) -> None:
+        if self.parallel is not None:
+            self.parallel.close()
+            self.parallel = None
+
+    @timed("popularity.getPlaylist")
     def getPlaylist(self, user_ids: List[int], number_of_songs=10) -> List[str]:
-        self.genre_coefficient = self.genre_coefficient / len(user_ids)
-        users_genres = self._aggregate_users_genres(user_ids)
-        ranked_songs = self._rank_tracks(users_genres)
+        if self.parallel is not None:
+            return self.getPlaylists([user_ids], number_of_songs)[0]
+        genre_coefficient = self.genre_coefficient / len(user_ids)
+        with stage("popularity.aggregate_genres"):
+            users_genres = self._aggregate_users_genres(user_ids)
+        ranked_songs = self._rank_tracks(
+            users_genres, genre_coefficient, number_of_songs=number_of_songs
+        )
 
-        return [x["id"] for x in ranked_songs][:number_of_songs]
+        return [x["id"] for x in ranked_songs]
 
     def getPlaylist_with_ranks(
         self, user_ids: List[int], number_of_songs=10
     ) -> List[str]:
-        self.genre_coefficient = self.genre_coefficient / len(user_ids)
+        genre_coefficient = self.genre_coefficient / len(user_ids)
         users_genres = self._aggregate_users_genres(user_ids)
-        ranked_songs = self._rank_tracks(users_genres)
+        ranked_songs = self._rank_tracks(
+            users_genres, genre_coefficient, number_of_songs=number_of_songs
+        )
 
-        return ranked_songs[:number_of_songs]
+        return ranked_songs
 
+    @timed("popularity.rank_tracks_for_users")
     def rank_tracks_for_users(
         self, user_ids: List[int], track_ids: List[str]
     ) -> List[str]:
-        self.genre_coefficient = self.genre_coefficient / len(user_ids)
+        genre_coefficient = self.genre_coefficient / len(user_ids)
         users_genres = self._aggregate_users_genres(user_ids)
-        ranked_songs = self._rank_tracks(users_genres, track_ids)
+        ranked_songs = self._rank_tracks(
+            users_genres, genre_coefficient, track_ids
+        )
 
         return [x["id"] for x in ranked_songs]
 
+    @timed("popularity.getPlaylists")
+    def getPlaylists(
+        self, groups: List[List[int]], number_of_songs=10
+    ) -> List[List[str]]:
+        genre_counts = self.user_genres.group_genre_counts(groups)
+        genre_coefficients = self.genre_coefficient / np.array(
+            [len(user_ids) for user_ids in groups]
+        )
+        if self.parallel is not None:
+            return [
+                self.tracks.track_ids[rows].tolist()
+                for rows in self.parallel.top_n(
+                    number_of_songs,
+                    genre_counts=genre_counts.toarray(),
+                    genre_coefficients=genre_coefficients,
+                )
+            ]
+        playlists = []
+        for block in group_blocks(len(groups), len(self.tracks)):
+            scores = self.genre_index.popularity_scores_matrix(
+                genre_counts[block],
+                self.tracks.popularity,
+                genre_coefficients[block],
+            )
+            for group_scores in scores:
+                rows = top_n(group_scores, number_of_songs)
+                playlists.append(self.tracks.track_ids[rows].tolist())
+        return playlists
+
+    def group_scores(self, groups: List[List[int]]) -> np.ndarray:
+        # score of every track for every group, one row per group
+        genre_coefficients = self.genre_coefficient / np.array(
+            [len(user_ids) for user_ids in groups]
+        )
+        return self.genre_index.popularity_scores_matrix(
+            self.user_genres.group_genre_counts(groups),
+            self.tracks.popularity,
+            genre_coefficients,
+        )
+
     # ==================================================== ranking of the tracks
 
     def _rank_tracks(
         self,
-        users_genres: List[Tuple[str, int]],
+        users_genres: np.ndarray,
+        genre_coefficient: float,
         track_ids=False,
-    ) -> List[Tuple[str, int]]:
+        number_of_songs=None,
+    ) -> List[Dict]:
         if not track_ids:
-            track_ids = self.tracks_genres.keys()
-
-        ranked_tracks = []
-        for track_id in track_ids:
-            ranked_tracks.append(
-                {
-                    "id": track_id,
-                    "popularity": self._calculate_popularity(
-                        track_id, users_genres
-                    ),
-                }
+            rows = None
+            track_ids = self.tracks.track_ids
+            popularity = self.tracks.popularity
+        else:
+            rows = self.tracks.rows(track_ids)
+            popularity = self.tracks.popularity[rows]
+
+        with stage("popularity.score"):
+            scores = self.genre_index.popularity_scores(
+                users_genres, popularity, genre_coefficient, rows
             )
-
-        return sorted(
-            ranked_tracks,
-            key=lambda x: x["popularity"],
-            reverse=True,
-        )
+        with stage("popularity.sort"):
+            if number_of_songs is None:
+                order = rank_all(scores)
+            else:
+                order = top_n(scores, number_of_songs)
+        return [
+            {"id": str(track_ids[i]), "popularity": float(scores[i])}
+            for i in order
+        ]
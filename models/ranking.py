@@ -0,0 +1,34 @@
+import numpy as np
+from typing import Iterator
+
+# score matrices of a block of groups are kept under this many elements
+MAX_BLOCK_ELEMENTS = 2**24
+
+
+def unit_rows(matrix: np.ndarray) -> np.ndarray:
+    norms = np.linalg.norm(matrix, axis=-1, keepdims=True)
+    return np.divide(matrix, norms, out=np.zeros_like(matrix), where=norms != 0)
+
+
+def top_n(scores: np.ndarray, number_of_songs: int) -> np.ndarray:
+    # rows of the n highest scores, best first, ties in catalogue order
+    # like a stable sort; partitioning keeps it O(n_tracks) instead of
+    # sorting the whole catalogue
+    n = min(number_of_songs, len(scores))
+    if n <= 0:
+        return np.empty(0, dtype=np.int64)
+    kth_score = -np.partition(-scores, n - 1)[n - 1]
+    candidates = np.flatnonzero(scores >= kth_score)
+    return candidates[np.lexsort((candidates, -scores[candidates]))][:n]
+
+
+def rank_all(scores: np.ndarray) -> np.ndarray:
+    return np.argsort(-scores, kind="stable")
+
+
+def group_blocks(
+    number_of_groups: int, number_of_tracks: int
+) -> Iterator[slice]:
+    block_size = max(1, MAX_BLOCK_ELEMENTS // max(number_of_tracks, 1))
+    for start in range(0, number_of_groups, block_size):
+        yield slice(start, min(start + block_size, number_of_groups))
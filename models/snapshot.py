@@ -0,0 +1,84 @@
+import json
+import os
+import shutil
+import numpy as np
+from typing import Dict, Tuple
+
+from data.trackFeatureStore import TrackFeatureStore
+
+# bump when the arrays saved for a model change
+FORMAT_VERSION = 4
+
+
+def save_snapshot(
+    directory: str,
+    model_type: str,
+    params: Dict,
+    tracks: TrackFeatureStore,
+    components: Dict[str, Dict[str, np.ndarray]],
+    source_hash: str = None,
+) -> None:
+    # A snapshot is a directory of .npy files, one per array of every
+    # component, and meta.json describing the rest. The track store is
+    # shared by all models, so only its fingerprint is recorded. The
+    # snapshot is written aside and moved into place once complete.
+    tmp_directory = f"{directory}.{os.getpid()}.tmp"
+    shutil.rmtree(tmp_directory, ignore_errors=True)
+    os.makedirs(tmp_directory)
+    for component, arrays in components.items():
+        for name, array in arrays.items():
+            np.save(
+                os.path.join(tmp_directory, f"{component}.{name}.npy"), array
+            )
+    with open(os.path.join(tmp_directory, "meta.json"), "w") as file:
+        json.dump(
+            {
+                "format_version": FORMAT_VERSION,
+                "model": model_type,
+                "params": params,
+                "components": {
+                    component: list(arrays)
+                    for component, arrays in components.items()
+                },
+                "source_hash": source_hash,
+                "tracks": tracks.fingerprint,
+            },
+            file,
+        )
+    shutil.rmtree(directory, ignore_errors=True)
+    os.replace(tmp_directory, directory)
+
+
+def load_snapshot(
+    directory: str,
+    model_type: str,
+    tracks: TrackFeatureStore,
+    mmap=True,
+    source_hash: str = None,
+) -> Tuple[Dict, Dict[str, Dict[str, np.ndarray]]]:
+    # nothing is parsed or recomputed; with mmap the arrays are paged in
+    # on first use
+    with open(os.path.join(directory, "meta.json"), "r") as file:
+        meta = json.load(file)
+    if meta["format_version"] != FORMAT_VERSION:
+        raise ValueError(
+            f"Unsupported snapshot format: {meta['format_version']}"
+        )
+    if meta["model"] != model_type:
+        raise ValueError(f"Snapshot of {meta['model']}, not {model_type}")
+    if source_hash is not None and meta["source_hash"] != source_hash:
+        raise ValueError("Snapshot was built from different source data")
+    if meta["tracks"] != tracks.fingerprint:
+        raise ValueError("Snapshot was built on a different track store")
+
+    components = {
+        component: {
+            name: np.load(
+                os.path.join(directory, f"{component}.{name}.npy"),
+                mmap_mode="r" if mmap else None,
+            )
+            for name in names
+        }
+        for component, names in meta["components"].items()
+    }
+    return meta, components
@@ -1,103 +1,125 @@
 import pandas as pd
 import numpy as np
-from typing import List, Dict, Tuple
+from typing import Iterable, List, Dict, Tuple, Union
+
+from data.trackFeatureStore import TrackFeatureStore
+from models.genreIndex import GenreIndex
+from models.candidateIndex import CandidateIndex
+from models.userGenres import UserGenres
+from models.parallel import ParallelScorer
+from models.snapshot import save_snapshot, load_snapshot
+from models.ranking import unit_rows, top_n, rank_all, group_blocks
+from models.userVectors import UserVectors
+from instrumentation import stage, timed
+
+# cosine similarity times 100, with room for float32 rounding
+MAX_DISTANCE = 100 + 1e-3
 
 
 class TargetModel:
-    def __init__(self, genre_coefficient=0.5):
+    def __init__(self, genre_coefficient=0.5, candidates=None):
         self.genre_coefficient = genre_coefficient
+        self.parallel = None
+        # number of most popular tracks that seed the two-stage ranking;
+        # None scores the whole catalogue
+        self.candidates = candidates
 
+    @timed("target.fit")
     def fit(
         self,
         users: pd.DataFrame,
-        tracks: pd.DataFrame,
+        tracks: Union[pd.DataFrame, TrackFeatureStore],
         artists: pd.DataFrame,
-        sessions: pd.DataFrame,
+        sessions: Union[pd.DataFrame, Iterable[pd.DataFrame]],
     ) -> None:
         self.users = users
-        self.tracks = tracks
+        self.tracks = TrackFeatureStore.of(tracks)
         self.artists = artists
-        self.sessions = sessions
 
-        self.number_of_params = len(self.tracks.loc[0, "params"])
-        self.track_vectors = {}
-        for i in range(len(self.tracks)):
-            self.track_vectors[
-                self.tracks.loc[i, "track_id"]
-            ] = self._get_vector(self.tracks.loc[i, "params"])
+        self.number_of_params = self.tracks.number_of_params
+        self.track_units = self.tracks.unit_params
+        with stage("target.fit.user_vectors"):
+            self.user_vectors = UserVectors(self.tracks)
+            self.user_vectors.update(sessions)
+
+        with stage("target.fit.genre_index"):
+            self.users_genres = self._get_all_user_genres()
+            self.artists_genres = self._get_genres_for_artist()
+            self.genre_index = GenreIndex(
+                self.tracks, self.artists_genres, self.users_genres
+            )
+        with stage("target.fit.user_genres"):
+            self.user_genres = UserGenres(self.users, self.genre_index)
+        self.candidate_index = None
+        if self.candidates:
+            with stage("target.fit.candidate_index"):
+                self.candidate_index = CandidateIndex(
+                    self.genre_index, self.tracks.popularity
+                )
 
-        self.users_genres = self._get_all_user_genres()
-        self.artists_genres = self._get_genres_for_artist()
-        self.tracks_genres = self._get_genres_for_tracks()
+    def save(self, path: str, source_hash: str = None) -> None:
+        components = {
+            "user_vectors": self.user_vectors.arrays(),
+            "genre_index": self.genre_index.arrays(),
+            "user_genres": self.user_genres.arrays(),
+        }
+        if self.candidate_index is not None:
+            components["candidate_index"] = self.candidate_index.arrays()
+        save_snapshot(
+            path,
+            "target",
+            {
+                "genre_coefficient": self.genre_coefficient,
+                "candidates": self.candidates,
+            },
+            self.tracks,
+            components,
+            source_hash,
+        )
 
-    # ==================================================== user profile functions
+    @classmethod
+    def load(
+        cls,
+        path: str,
+        tracks: TrackFeatureStore,
+        mmap=True,
+        source_hash: str = None,
+    ) -> "TargetModel":
+        # the track store is not part of the snapshot, it is shared
+        meta, components = load_snapshot(
+            path, "target", tracks, mmap, source_hash
+        )
+        model = cls(**meta["params"])
+        # the raw frames passed to fit are not part of the snapshot
+        model.users = None
+        model.artists = None
+        model.tracks = tracks
+        model.number_of_params = tracks.number_of_params
+        model.track_units = tracks.unit_params
+        model.user_vectors = UserVectors.from_arrays(
+            tracks, components["user_vectors"]
+        )
+        model.genre_index = GenreIndex.from_arrays(components["genre_index"])
+        model.user_genres = UserGenres.from_arrays(components["user_genres"])
+        model.candidate_index = None
+        if "candidate_index" in components:
+            model.candidate_index = CandidateIndex.from_arrays(
+                components["candidate_index"]
+            )
+        return model
 
-    def _get_vector(self, params: List) -> np.ndarray:
-        return np.array(params, dtype=np.float)
+    # ==================================================== user profile functions
 
     def _get_user_vector(self, user_id: int) -> np.ndarray:
-        user_vector = []
-        for i in range(len(self.sessions)):
-            if self.sessions.loc[i, "user_id"] == user_id:
-                match self.sessions.loc[i, "event"]:
-                    case "play":
-                        weight = 1
-                    case "skip":
-                        weight = -1
-                    case "like":
-                        weight = 2
-                    case _:
-                        weight = 0
-                user_vector.append(
-                    (
-                        self.track_vectors[self.sessions.loc[i, "track_id"]],
-                        weight,
-                    )
-                )
-        return self._calculate_average_vector(user_vector)
-
-    def _calculate_average_vector(
-        self, vectors: List[Tuple[List[float], float]]
-    ) -> np.ndarray:
-        avg_vcector = np.zeros(shape=self.number_of_params, dtype=float)
-
-        sum_weight = 0
-        for vec in vectors:
-            sum_weight += vec[1]
-            avg_vcector += vec[0] * (vec[1] * np.ones(self.number_of_params))
-
-        return avg_vcector / (sum_weight * np.ones(self.number_of_params))
+        return self.user_vectors.vector(user_id)
 
     def _aggregated_users_vector(self, user_ids: List[int]) -> np.ndarray:
-        user_vectors = []
-        for user_id in user_ids:
-            user_vectors.append(self._get_user_vector(user_id))
-
-        avg_vcector = np.zeros(shape=self.number_of_params, dtype=float)
-
-        for vec in user_vectors:
-            avg_vcector += vec
-
-        return avg_vcector / (
-            len(user_vectors) * np.ones(self.number_of_params)
-        )
-
-    def _calculate_difference(
-        self, vec1: np.ndarray, vec2: np.ndarray
-    ) -> float:
-        return (
-            np.dot(vec1, vec2)
-            / (np.linalg.norm(vec1) * np.linalg.norm(vec2))
-            * 100
-        )
+        return self.user_vectors.vectors_for(user_ids).mean(axis=0)
 
     # ==================================================== popularity functions
 
     def _get_all_user_genres(self) -> List[str]:
-        all_genres = set()
-        for i in range(len(self.users)):
-            all_genres.update(self.users.loc[i, "favourite_genres"])
-        return all_genres
+        return set(self.users["favourite_genres"].explode().dropna())
 
     def _get_genres_for_artist(self) -> Dict:
         genres_for_artist = {}
@@ -107,103 +129,253 @@ class TargetModel:
             ] = self.artists.loc[i, "genres"]
         return genres_for_artist
 
-    def _get_genres_for_tracks(self) -> Dict:
-        tracks_with_genres = {}
-        for i in range(len(self.tracks)):
-            tracks_with_genres[self.tracks.loc[i, "track_id"]] = {
-                "popularity": self.tracks.loc[i, "popularity"],
-                "genres": self.artists_genres[self.tracks.loc[i, "artist_id"]],
-            }
-        return tracks_with_genres
-
-    def _aggregate_users_genres(self, user_ids: List[int]) -> Dict:
-        users_genres = {}
-        for user_id in user_ids:
-            for genre in self._genres_for_user(user_id):
-                if genre not in users_genres:
-                    users_genres[f"{genre}"] = 1
-                else:
-                    users_genres[f"{genre}"] += 1
-        return users_genres
+    def _aggregate_users_genres(self, user_ids: List[int]) -> np.ndarray:
+        return self.user_genres.genre_counts(user_ids)
 
     def _genres_for_user(self, user_id: int) -> List[str]:
-        for i in range(len(self.users)):
-            if self.users.loc[i, "user_id"] == user_id:
-                return self.users.loc[i, "favourite_genres"]
+        return self.user_genres.genres_of(user_id, self.genre_index)
 
-    def _calculate_popularity(
-        self, track_id: str, users_genres: List[Tuple[str, int]]
-    ) -> float:
-        track_dict = self.tracks_genres[track_id]
-        popularity_level = -0.1
-        for genre, n_of_occurrences in list(users_genres.items()):
-            if genre in track_dict["genres"]:
-                popularity_level += n_of_occurrences
-        return track_dict["popularity"] + (
-            (
-                (100 - track_dict["popularity"])
-                * popularity_level
-                * self.genre_coefficient
-            )
+    # ==================================================== public methods
+
+    def unknown_users(self, user_ids: List[int]) -> List[int]:
+        # ids that were not in the users the model was fitted on
+        return self.user_genres.unknown(user_ids)
+
+    def partial_fit(
+        self, events: Union[pd.DataFrame, List[Dict], Iterable[pd.DataFrame]]
+    ) -> None:
+        # Folds new like/play/skip events into the fitted user vectors
+        # without a refit; the next request already sees them.
+        self.user_vectors.update(events)
+
+    def update(self, events: pd.DataFrame) -> None:
+        self.partial_fit(events)
+
+    def enable_parallel(self, n_workers=None) -> None:
+        self.disable_parallel()
+        self.parallel = ParallelScorer(
+            self.tracks, self.genre_index, n_workers=n_workers
         )
 
-    # ==================================================== public methods
+    def disable_parallel(self) -> None:
+        if self.parallel is not None:
+            self.parallel.close()
+            self.parallel = None
 
+    @timed("target.getPlaylist")
     def getPlaylist(self, user_ids: List[int], number_of_songs=10) -> List[str]:
-        self.genre_coefficient = self.genre_coefficient / len(user_ids)
-        users_genres = self._aggregate_users_genres(user_ids)
-        users_vector = self._aggregated_users_vector(user_ids)
-
-        ranked_songs = self._rank_tracks(users_genres, users_vector)
-        return [x["id"] for x in ranked_songs][:number_of_songs]
+        if self.parallel is not None:
+            return self.getPlaylists([user_ids], number_of_songs)[0]
+        genre_coefficient = self.genre_coefficient / len(user_ids)
+        with stage("target.aggregate_genres"):
+            users_genres = self._aggregate_users_genres(user_ids)
+        with stage("target.aggregate_vectors"):
+            users_vector = self._aggregated_users_vector(user_ids)
+
+        ranked_songs = self._rank_tracks(
+            users_genres,
+            users_vector,
+            genre_coefficient,
+            number_of_songs=number_of_songs,
+        )
+        return [x["id"] for x in ranked_songs]
 
     def getPlaylist_with_ranks(
         self, user_ids: List[int], number_of_songs=10
     ) -> List[str]:
-        self.genre_coefficient = self.genre_coefficient / len(user_ids)
+        genre_coefficient = self.genre_coefficient / len(user_ids)
         users_genres = self._aggregate_users_genres(user_ids)
         users_vector = self._aggregated_users_vector(user_ids)
 
-        ranked_songs = self._rank_tracks(users_genres, users_vector)
-        return ranked_songs[:number_of_songs]
+        ranked_songs = self._rank_tracks(
+            users_genres,
+            users_vector,
+            genre_coefficient,
+            number_of_songs=number_of_songs,
+        )
+        return ranked_songs
 
+    @timed("target.rank_tracks_for_users")
     def rank_tracks_for_users(
         self, user_ids: List[int], track_ids: List[str]
     ) -> List[str]:
-        self.genre_coefficient = self.genre_coefficient / len(user_ids)
+        genre_coefficient = self.genre_coefficient / len(user_ids)
         users_genres = self._aggregate_users_genres(user_ids)
         users_vector = self._aggregated_users_vector(user_ids)
 
-        ranked_songs = self._rank_tracks(users_genres, users_vector, track_ids)
+        ranked_songs = self._rank_tracks(
+            users_genres, users_vector, genre_coefficient, track_ids
+        )
         return [x["id"] for x in ranked_songs]
 
+    def candidate_recall(
+        self, groups: List[List[int]], number_of_songs=10
+    ) -> float:
+        # share of the exhaustive top N that the two-stage ranking also
+        # returns
+        found = 0
+        expected = 0
+        for user_ids in groups:
+            genre_coefficient = self.genre_coefficient / len(user_ids)
+            users_genres = self._aggregate_users_genres(user_ids)
+            users_vector = self._aggregated_users_vector(user_ids)
+            exact, ranked = (
+                self._rank_tracks(
+                    users_genres,
+                    users_vector,
+                    genre_coefficient,
+                    number_of_songs=number_of_songs,
+                    exact=exact,
+                )
+                for exact in (True, False)
+            )
+            found += len({x["id"] for x in exact} & {x["id"] for x in ranked})
+            expected += len(exact)
+        return found / expected if expected else 1.0
+
+    @timed("target.getPlaylists")
+    def getPlaylists(
+        self, groups: List[List[int]], number_of_songs=10
+    ) -> List[List[str]]:
+        groups_vectors = unit_rows(
+            self.user_vectors.group_vectors(groups).astype(np.float32)
+        )
+        genre_counts = self.user_genres.group_genre_counts(groups)
+        genre_coefficients = self.genre_coefficient / np.array(
+            [len(user_ids) for user_ids in groups]
+        )
+        if self.parallel is not None:
+            return [
+                self.tracks.track_ids[rows].tolist()
+                for rows in self.parallel.top_n(
+                    number_of_songs,
+                    vectors=groups_vectors,
+                    genre_counts=genre_counts.toarray(),
+                    genre_coefficients=genre_coefficients,
+                )
+            ]
+        playlists = []
+        for block in group_blocks(len(groups), len(self.tracks)):
+            distances = groups_vectors[block] @ self.track_units.T * 100
+            popularities = self.genre_index.popularity_scores_matrix(
+                genre_counts[block],
+                self.tracks.popularity,
+                genre_coefficients[block],
+            )
+            for group_scores in distances + popularities:
+                rows = top_n(group_scores, number_of_songs)
+                playlists.append(self.tracks.track_ids[rows].tolist())
+        return playlists
+
+    def group_scores(self, groups: List[List[int]]) -> np.ndarray:
+        # score of every track for every group, one row per group
+        groups_vectors = unit_rows(
+            self.user_vectors.group_vectors(groups).astype(np.float32)
+        )
+        genre_coefficients = self.genre_coefficient / np.array(
+            [len(user_ids) for user_ids in groups]
+        )
+        distances = groups_vectors @ self.track_units.T * 100
+        return distances + self.genre_index.popularity_scores_matrix(
+            self.user_genres.group_genre_counts(groups),
+            self.tracks.popularity,
+            genre_coefficients,
+        )
+
     # ==================================================== ranking of the tracks
 
     def _rank_tracks(
         self,
-        users_genres: List[Tuple[str, int]],
+        users_genres: np.ndarray,
         users_vector: np.ndarray,
+        genre_coefficient: float,
         track_ids=False,
-    ) -> List[Tuple[str, int]]:
-        if not track_ids:
-            track_ids = self.track_vectors.keys()
-
-        ranked_tracks = []
-        for track_id in track_ids:
-            ranked_tracks.append(
-                {
-                    "id": track_id,
-                    "distance": self._calculate_difference(
-                        users_vector, self.track_vectors[track_id]
-                    ),
-                    "popularity": self._calculate_popularity(
-                        track_id, users_genres
-                    ),
-                }
+        number_of_songs=None,
+        exact=False,
+    ) -> List[Dict]:
+        candidates = None
+        if (
+            not track_ids
+            and number_of_songs is not None
+            and self.candidates
+            and not exact
+        ):
+            with stage("target.candidates"):
+                candidates = self._candidates(
+                    users_genres,
+                    users_vector,
+                    genre_coefficient,
+                    number_of_songs,
+                )
+        if candidates is not None:
+            rows, popularities = candidates
+            track_units = self.track_units[rows]
+        elif not track_ids:
+            rows = None
+            track_ids = self.tracks.track_ids
+            track_units = self.track_units
+            popularity = self.tracks.popularity
+        else:
+            rows = self.tracks.rows(track_ids)
+            track_units = self.track_units[rows]
+            popularity = self.tracks.popularity[rows]
+
+        with stage("target.score"):
+            distances = (
+                track_units @ unit_rows(users_vector.astype(np.float32)) * 100
             )
+            if candidates is None:
+                popularities = self.genre_index.popularity_scores(
+                    users_genres, popularity, genre_coefficient, rows
+                )
+            scores = distances + popularities
+        with stage("target.sort"):
+            if number_of_songs is None:
+                order = rank_all(scores)
+            else:
+                order = top_n(scores, number_of_songs)
+        if candidates is not None:
+            # only the ids that are returned are looked up
+            track_ids = dict(zip(order, self.tracks.track_ids[rows[order]]))
+        return [
+            {
+                "id": str(track_ids[i]),
+                "distance": float(distances[i]),
+                "popularity": float(popularities[i]),
+            }
+            for i in order
+        ]
 
-        return sorted(
-            ranked_tracks,
-            key=lambda x: x["distance"] + x["popularity"],
-            reverse=True,
+    def _candidates(
+        self,
+        users_genres: np.ndarray,
+        users_vector: np.ndarray,
+        genre_coefficient: float,
+        number_of_songs: int,
+    ) -> Tuple[np.ndarray, np.ndarray]:
+        # First stage of the two-stage ranking. The tracks with the best
+        # popularity term of their genre group give a lower bound on the
+        # n-th score. A distance is at most 100, so only tracks whose
+        # popularity term is within 100 of that bound can reach the top n;
+        # their rows and popularity terms are returned for the full score.
+        rows = self.candidate_index.first_rows(
+            users_genres, genre_coefficient, self.candidates
+        )
+        if len(rows) < number_of_songs:
+            return None
+        distances = (
+            self.track_units[rows]
+            @ unit_rows(users_vector.astype(np.float32))
+            * 100
+        )
+        scores = distances + self.genre_index.popularity_scores(
+            users_genres,
+            self.tracks.popularity[rows],
+            genre_coefficient,
+            rows,
+        )
+        return self.candidate_index.rows_above(
+            users_genres,
+            genre_coefficient,
+            scores[top_n(scores, number_of_songs)[-1]] - MAX_DISTANCE,
         )
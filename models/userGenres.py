@@ -0,0 +1,73 @@
+import numpy as np
+import pandas as pd
+from scipy import sparse
+from typing import List, Dict
+
+from models.genreIndex import GenreIndex, csr_arrays, csr_from_arrays
+
+
+class UserGenres:
+    # Favourite genres of every user as a sparse users x genres count
+    # matrix, with a user_id -> row index for O(1) lookups.
+    def __init__(self, users: pd.DataFrame, genre_index: GenreIndex) -> None:
+        self.index: Dict[int, int] = {
+            user_id: row
+            for row, user_id in enumerate(users["user_id"].tolist())
+        }
+        user_rows, genre_columns = [], []
+        for row, genres in enumerate(users["favourite_genres"].tolist()):
+            for genre in genres:
+                if genre in genre_index.genres:
+                    user_rows.append(row)
+                    genre_columns.append(genre_index.genres[genre])
+        self.counts = sparse.csr_matrix(
+            (np.ones(len(user_rows)), (user_rows, genre_columns)),
+            shape=(len(self.index), len(genre_index.genres)),
+        )
+
+    def arrays(self) -> Dict[str, np.ndarray]:
+        return {
+            "user_ids": np.array(list(self.index), dtype=np.int64),
+            "rows": np.array(list(self.index.values()), dtype=np.int64),
+            **csr_arrays(self.counts),
+        }
+
+    @classmethod
+    def from_arrays(cls, arrays: Dict[str, np.ndarray]) -> "UserGenres":
+        user_genres = cls.__new__(cls)
+        user_genres.index = dict(
+            zip(arrays["user_ids"].tolist(), arrays["rows"].tolist())
+        )
+        user_genres.counts = csr_from_arrays(arrays)
+        return user_genres
+
+    def row(self, user_id: int) -> int:
+        try:
+            return self.index[user_id]
+        except KeyError:
+            raise KeyError(f"Unknown user id: {user_id}") from None
+
+    def unknown(self, user_ids: List[int]) -> List[int]:
+        return [user_id for user_id in user_ids if user_id not in self.index]
+
+    def genres_of(self, user_id: int, genre_index: GenreIndex) -> List[str]:
+        # favourite genres of the user, in genre index order
+        columns = self.counts[self.row(user_id)].indices
+        genres = list(genre_index.genres)
+        return [genres[column] for column in np.sort(columns)]
+
+    def genre_counts(self, user_ids: List[int]) -> np.ndarray:
+        rows = [self.row(user_id) for user_id in user_ids]
+        return np.asarray(self.counts[rows].sum(axis=0)).ravel()
+
+    def group_genre_counts(self, groups: List[List[int]]) -> sparse.csr_matrix:
+        group_rows, user_rows = [], []
+        for group_row, user_ids in enumerate(groups):
+            for user_id in user_ids:
+                group_rows.append(group_row)
+                user_rows.append(self.row(user_id))
+        membership = sparse.csr_matrix(
+            (np.ones(len(user_rows)), (group_rows, user_rows)),
+            shape=(len(groups), len(self.index)),
+        )
+        return membership @ self.counts
@@ -1,60 +1,103 @@
 import pandas as pd
 import numpy as np
-from typing import List, Dict, Tuple
+from typing import Iterable, List, Dict, Tuple, Union
 
+from data.trackFeatureStore import TrackFeatureStore
+from models.userVectors import UserVectors
+from models.annIndex import IVFIndex
+from models.parallel import ParallelScorer
+from models.snapshot import save_snapshot, load_snapshot
+from models.ranking import unit_rows, top_n, rank_all, group_blocks
+from instrumentation import stage, timed
 
-class UserProfileModel:
-    def __init__(self) -> None:
-        pass
 
+class UserProfileModel:
+    def __init__(self, ann_partitions=0, ann_probe=8) -> None:
+        # ann_partitions > 0 enables approximate retrieval; probing more
+        # partitions trades speed for recall
+        self.ann_partitions = ann_partitions
+        self.ann_probe = ann_probe
+        self.parallel = None
+
+    @timed("user_profile.fit")
     def fit(
-        self, users: pd.DataFrame, tracks: pd.DataFrame, sessions: pd.DataFrame
+        self,
+        users: pd.DataFrame,
+        tracks: Union[pd.DataFrame, TrackFeatureStore],
+        sessions: Union[pd.DataFrame, Iterable[pd.DataFrame]],
     ) -> None:
         self.users = users
-        self.tracks = tracks
-        self.sessions = sessions
-        self.number_of_params = len(self.tracks.loc[0, "params"])
-        self.track_vectors = {}
-        for i in range(len(self.tracks)):
-            self.track_vectors[
-                self.tracks.loc[i, "track_id"]
-            ] = self._get_vector(self.tracks.loc[i, "params"])
-
-    def _get_vector(self, params: List) -> np.ndarray:
-        return np.array(params, dtype=np.float)
-
-    def _get_user_vector(self, user_id: int) -> np.ndarray:
-        user_vector = []
-        for i in range(len(self.sessions)):
-            if self.sessions.loc[i, "user_id"] == user_id:
-                match self.sessions.loc[i, "event"]:
-                    case "play":
-                        weight = 1
-                    case "skip":
-                        weight = -1
-                    case "like":
-                        weight = 2
-                    case _:
-                        weight = 0
-                user_vector.append(
-                    (
-                        self.track_vectors[self.sessions.loc[i, "track_id"]],
-                        weight,
-                    )
-                )
-        return self._calculate_average_vector(user_vector)
-
-    def _calculate_average_vector(
-        self, vectors: List[Tuple[List[float], float]]
-    ) -> np.ndarray:
-        avg_vcector = np.zeros(shape=self.number_of_params, dtype=float)
+        self.user_ids = np.sort(users["user_id"].to_numpy(dtype=np.int64))
+        self.tracks = TrackFeatureStore.of(tracks)
+        self.number_of_params = self.tracks.number_of_params
+        with stage("user_profile.fit.user_vectors"):
+            self.user_vectors = UserVectors(self.tracks)
+            self.user_vectors.update(sessions)
+        self.track_units = self.tracks.unit_params
+        self.ann_index = None
+        if self.ann_partitions:
+            with stage("user_profile.fit.ann_index"):
+                self.ann_index = IVFIndex(self.track_units, self.ann_partitions)
+
+    def save(self, path: str, source_hash: str = None) -> None:
+        components = {
+            "users": {"user_ids": self.user_ids},
+            "user_vectors": self.user_vectors.arrays(),
+        }
+        if self.ann_index is not None:
+            components["ann_index"] = self.ann_index.arrays()
+        save_snapshot(
+            path,
+            "user_profile",
+            {
+                "ann_partitions": self.ann_partitions,
+                "ann_probe": self.ann_probe,
+            },
+            self.tracks,
+            components,
+            source_hash,
+        )
 
-        sum_weight = 0
-        for vec in vectors:
-            sum_weight += vec[1]
-            avg_vcector += vec[0] * (vec[1] * np.ones(self.number_of_params))
+    @classmethod
+    def load(
+        cls,
+        path: str,
+        tracks: TrackFeatureStore,
+        mmap=True,
+        source_hash: str = None,
+    ) -> "UserProfileModel":
+        # the track store is not part of the snapshot, it is shared
+        meta, components = load_snapshot(
+            path, "user_profile", tracks, mmap, source_hash
+        )
+        model = cls(**meta["params"])
+        # the raw frames passed to fit are not part of the snapshot
+        model.users = None
+        model.user_ids = components["users"]["user_ids"]
+        model.tracks = tracks
+        model.number_of_params = tracks.number_of_params
+        model.user_vectors = UserVectors.from_arrays(
+            tracks, components["user_vectors"]
+        )
+        model.track_units = tracks.unit_params
+        model.ann_index = None
+        if "ann_index" in components:
+            model.ann_index = IVFIndex.from_arrays(
+                model.track_units, components["ann_index"]
+            )
+        return model
 
-        return avg_vcector / (sum_weight * np.ones(self.number_of_params))
+    def _get_user_vector(self, user_id: int) -> np.ndarray:
+        return self.user_vectors.vector(user_id)
+
+    def unknown_users(self, user_ids: List[int]) -> List[int]:
+        # ids that were not in the users the model was fitted on
+        known = np.isin(user_ids, self.user_ids)
+        return [
+            user_id
+            for user_id, is_known in zip(user_ids, known)
+            if not is_known
+        ]
 
     def _aggregate_user_vectors(
         self, user_vectors: List[np.ndarray]
@@ -68,53 +111,66 @@ class UserProfileModel:
             len(user_vectors) * np.ones(self.number_of_params)
         )
 
+    def _unit_vector(self, vector: np.ndarray) -> np.ndarray:
+        return unit_rows(vector.astype(np.float32))
+
     def _find_best_tracks(
-        self, vector: np.ndarray, number_of_songs: int
-    ) -> List[str]:
-        vector_difference = []
-        for i in range(len(self.tracks)):
-            vector_difference.append(
-                (
-                    self._calculate_difference(
-                        vector, self._get_vector(self.tracks.loc[i, "params"])
-                    ),
-                    self.tracks.loc[i, "track_id"],
+        self, vector: np.ndarray, number_of_songs: int, exact=False
+    ) -> List[Tuple[float, str]]:
+        if self.ann_index is not None and not exact:
+            with stage("user_profile.ann_search"):
+                rows, scores = self.ann_index.search(
+                    self._unit_vector(vector), number_of_songs, self.ann_probe
                 )
-            )
-        return sorted(vector_difference, key=lambda x: x[0], reverse=True)[
-            :number_of_songs
+        else:
+            with stage("user_profile.score"):
+                scores = self.track_units @ self._unit_vector(vector)
+            with stage("user_profile.sort"):
+                rows = top_n(scores, number_of_songs)
+            scores = scores[rows]
+        return [
+            (float(score), str(self.tracks.track_ids[row]))
+            for row, score in zip(rows, scores)
         ]
 
-    def _calculate_difference(
-        self, vec1: np.ndarray, vec2: np.ndarray
-    ) -> float:
-        return np.dot(vec1, vec2) / (
-            np.linalg.norm(vec1) * np.linalg.norm(vec2)
-        )
-
     def _rank_tracks_for_vector(
         self, users_vector: np.ndarray, track_ids: List[str]
-    ) -> List[str]:
-        vector_difference = []
-        for track_id in track_ids:
-            vector_difference.append(
-                (
-                    self._calculate_difference(
-                        users_vector, self.track_vectors[track_id]
-                    ),
-                    track_id,
-                )
-            )
-        return sorted(vector_difference, key=lambda x: x[0], reverse=True)
+    ) -> List[Tuple[float, str]]:
+        rows = self.tracks.rows(track_ids)
+        scores = self.track_units[rows] @ self._unit_vector(users_vector)
+        return [(float(scores[i]), track_ids[i]) for i in rank_all(scores)]
 
     # ==================================================== public methods
 
-    def getPlaylist(self, user_ids: List[int], number_of_songs=10) -> List[str]:
-        user_vectors = []
-        for user_id in user_ids:
-            user_vectors.append(self._get_user_vector(user_id))
+    def partial_fit(
+        self, events: Union[pd.DataFrame, List[Dict], Iterable[pd.DataFrame]]
+    ) -> None:
+        # Folds new like/play/skip events into the fitted user vectors
+        # without a refit; the next request already sees them.
+        self.user_vectors.update(events)
 
-        aggregated_vector = self._aggregate_user_vectors(user_vectors)
+    def update(self, events: pd.DataFrame) -> None:
+        self.partial_fit(events)
+
+    def enable_parallel(self, n_workers=None) -> None:
+        self.disable_parallel()
+        self.parallel = ParallelScorer(self.tracks, n_workers=n_workers)
+
+    def disable_parallel(self) -> None:
+        if self.parallel is not None:
+            self.parallel.close()
+            self.parallel = None
+
+    @timed("user_profile.getPlaylist")
+    def getPlaylist(self, user_ids: List[int], number_of_songs=10) -> List[str]:
+        if self.parallel is not None and self.ann_index is None:
+            return self.getPlaylists([user_ids], number_of_songs)[0]
+        with stage("user_profile.aggregate_vectors"):
+            user_vectors = []
+            for user_id in user_ids:
+                user_vectors.append(self._get_user_vector(user_id))
+
+            aggregated_vector = self._aggregate_user_vectors(user_vectors)
         tracks_in_order = self._find_best_tracks(
             aggregated_vector, number_of_songs
         )
@@ -133,6 +189,7 @@ class UserProfileModel:
         )
         return tracks_in_order
 
+    @timed("user_profile.rank_tracks_for_users")
     def rank_tracks_for_users(
         self, user_ids: List[int], track_ids: List[str]
     ) -> List[str]:
@@ -145,3 +202,45 @@ class UserProfileModel:
             aggregated_vector, track_ids
         )
         return [x[1] for x in tracks_in_order]
+
+    def ann_recall(self, groups: List[List[int]], number_of_songs=10) -> float:
+        # share of the exact top N that the approximate search also returns
+        found = 0
+        expected = 0
+        for user_ids in groups:
+            vector = self._aggregate_user_vectors(
+                [self._get_user_vector(user_id) for user_id in user_ids]
+            )
+            exact = self._find_best_tracks(vector, number_of_songs, exact=True)
+            approximate = self._find_best_tracks(vector, number_of_songs)
+            found += len({x[1] for x in exact} & {x[1] for x in approximate})
+            expected += len(exact)
+        return found / expected if expected else 1.0
+
+    @timed("user_profile.getPlaylists")
+    def getPlaylists(
+        self, groups: List[List[int]], number_of_songs=10
+    ) -> List[List[str]]:
+        groups_vectors = unit_rows(
+            self.user_vectors.group_vectors(groups).astype(np.float32)
+        )
+        if self.parallel is not None:
+            return [
+                self.tracks.track_ids[rows].tolist()
+                for rows in self.parallel.top_n(
+                    number_of_songs, vectors=groups_vectors
+                )
+            ]
+        playlists = []
+        for block in group_blocks(len(groups), len(self.tracks)):
+            for group_scores in groups_vectors[block] @ self.track_units.T:
+                rows = top_n(group_scores, number_of_songs)
+                playlists.append(self.tracks.track_ids[rows].tolist())
+        return playlists
+
+    def group_scores(self, groups: List[List[int]]) -> np.ndarray:
+        # score of every track for every group, one row per group
+        groups_vectors = unit_rows(
+            self.user_vectors.group_vectors(groups).astype(np.float32)
+        )
+        return groups_vectors @ self.track_units.T
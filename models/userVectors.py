@@ -0,0 +1,187 @@
+import threading
+import numpy as np
+import pandas as pd
+from scipy import sparse
+from typing import Dict, Iterable, List, Union
+
+from data.trackFeatureStore import TrackFeatureStore
+
+EVENT_WEIGHTS = {"play": 1, "skip": -1, "like": 2}
+# rows allocated at least, and the factor the capacity grows by
+MIN_CAPACITY = 1024
+GROWTH_FACTOR = 2
+
+
+class UserVectors:
+    # Weighted sums of the tracks each user interacted with, one row per
+    # user. A user's preference vector is the sum divided by the total
+    # weight, kept up to date as new events are added. The arrays keep
+    # spare rows, so adding users rarely copies them.
+    def __init__(self, tracks: TrackFeatureStore) -> None:
+        self.tracks = tracks
+        self.number_of_params = tracks.number_of_params
+        self.index: Dict[int, int] = {}
+        self.sums = np.zeros((0, self.number_of_params), dtype=np.float64)
+        self.weights = np.zeros(0, dtype=np.float64)
+        self.vectors = np.zeros((0, self.number_of_params), dtype=np.float64)
+        self._lock = threading.Lock()
+
+    def __len__(self) -> int:
+        return len(self.index)
+
+    # ==================================================== snapshots
+
+    def arrays(self) -> Dict[str, np.ndarray]:
+        # index keys are in row order; the lock keeps rows and ids in step,
+        # and the rows are copied as updates write them in place
+        with self._lock:
+            size = len(self.index)
+            return {
+                "user_ids": np.fromiter(self.index, dtype=np.int64, count=size),
+                "sums": self.sums[:size].copy(),
+                "weights": self.weights[:size].copy(),
+                "vectors": self.vectors[:size].copy(),
+            }
+
+    @classmethod
+    def from_arrays(
+        cls, tracks: TrackFeatureStore, arrays: Dict[str, np.ndarray]
+    ) -> "UserVectors":
+        # memory-mapped arrays are only read; the first update copies them
+        user_vectors = cls(tracks)
+        user_vectors.sums = arrays["sums"]
+        user_vectors.weights = arrays["weights"]
+        user_vectors.vectors = arrays["vectors"]
+        user_vectors.index = {
+            user_id: row
+            for row, user_id in enumerate(arrays["user_ids"].tolist())
+        }
+        return user_vectors
+
+    # the lock can't be pickled, a restored copy gets a fresh one
+    def __getstate__(self) -> Dict:
+        state = self.__dict__.copy()
+        del state["_lock"]
+        return state
+
+    def __setstate__(self, state: Dict) -> None:
+        self.__dict__.update(state)
+        self._lock = threading.Lock()
+
+    def update(
+        self, events: Union[pd.DataFrame, List[Dict], Iterable[pd.DataFrame]]
+    ) -> None:
+        # accepts one frame of events, a list of log entries or an iterable
+        # of chunks of them
+        if isinstance(events, pd.DataFrame):
+            events = [events]
+        elif (
+            isinstance(events, list) and events and isinstance(events[0], dict)
+        ):
+            events = [pd.DataFrame(events)]
+        for chunk in events:
+            self._update_chunk(chunk)
+
+    def _update_chunk(self, events: pd.DataFrame) -> None:
+        # Only the rows of users in the chunk are written, in place. Rows of
+        # new users are filled before their ids enter the index, and grown
+        # arrays are published before the index, so readers, which take the
+        # index first and the arrays second, never see a missing row.
+        user_ids, track_rows, weights = self._weighted_events(events)
+        if len(user_ids) == 0:
+            return
+        with self._lock:
+            chunk_users, inverse = np.unique(user_ids, return_inverse=True)
+            new_users = {}
+            rows = np.empty(len(chunk_users), dtype=np.int64)
+            for i, user_id in enumerate(chunk_users.tolist()):
+                row = self.index.get(user_id)
+                if row is None:
+                    row = new_users[user_id] = len(self.index) + len(new_users)
+                rows[i] = row
+            self._reserve(len(self.index) + len(new_users))
+
+            contributions = self.tracks.params[track_rows] * weights[:, None]
+            chunk_sums = np.zeros((len(rows), self.number_of_params))
+            for param in range(self.number_of_params):
+                chunk_sums[:, param] = np.bincount(
+                    inverse,
+                    weights=contributions[:, param],
+                    minlength=len(rows),
+                )
+            chunk_weights = np.bincount(
+                inverse, weights=weights, minlength=len(rows)
+            )
+
+            sums = self.sums[rows] + chunk_sums
+            total_weights = self.weights[rows] + chunk_weights
+            self.sums[rows] = sums
+            self.weights[rows] = total_weights
+            self.vectors[rows] = np.divide(
+                sums,
+                total_weights[:, None],
+                out=np.zeros((len(rows), self.number_of_params)),
+                where=total_weights[:, None] != 0,
+            )
+            self.index.update(new_users)
+
+    def _reserve(self, size: int) -> None:
+        # grows the arrays geometrically, and copies memory-mapped ones
+        # before they are first written
+        capacity = len(self.weights)
+        if size <= capacity and self.weights.flags.writeable:
+            return
+        if size > capacity:
+            capacity = max(size, capacity * GROWTH_FACTOR, MIN_CAPACITY)
+        used = len(self.index)
+        sums = np.zeros((capacity, self.number_of_params))
+        weights = np.zeros(capacity)
+        vectors = np.zeros((capacity, self.number_of_params))
+        sums[:used] = self.sums[:used]
+        weights[:used] = self.weights[:used]
+        vectors[:used] = self.vectors[:used]
+        self.sums, self.weights, self.vectors = sums, weights, vectors
+
+    def vector(self, user_id: int) -> np.ndarray:
+        # users without any history have no preference yet
+        row = self.index.get(user_id)
+        if row is None:
+            return np.zeros(self.number_of_params, dtype=np.float64)
+        return self.vectors[row]
+
+    def vectors_for(self, user_ids: List[int]) -> np.ndarray:
+        return np.array([self.vector(user_id) for user_id in user_ids])
+
+    def group_vectors(self, groups: List[List[int]]) -> np.ndarray:
+        # mean preference vector of every group, one row per group; the
+        # arrays are taken after the rows, so they hold all of them
+        index = self.index
+        group_rows, user_rows = [], []
+        for group_row, user_ids in enumerate(groups):
+            for user_id in user_ids:
+                if user_id in index:
+                    group_rows.append(group_row)
+                    user_rows.append(index[user_id])
+        vectors = self.vectors
+        membership = sparse.csr_matrix(
+            (np.ones(len(user_rows)), (group_rows, user_rows)),
+            shape=(len(groups), len(vectors)),
+        )
+        group_sizes = np.array([len(user_ids) for user_ids in groups])
+        return (membership @ vectors) / group_sizes[:, None]
+
+    def _weighted_events(self, events: pd.DataFrame):
+        # frames from the sessions loaders call the column "event", raw log
+        # entries "event_type"
+        column = "event" if "event" in events else "event_type"
+        event_types = np.asarray(events[column], dtype=object)
+        weights = np.zeros(len(event_types), dtype=np.float64)
+        for event_type, weight in EVENT_WEIGHTS.items():
+            weights[event_types == event_type] = weight
+
+        track_rows = self.tracks.lookup(np.asarray(events["track_id"]))
+        # events with no weight or for tracks outside the catalogue do not
+        # move the user's vector
+        useful = (weights != 0) & (track_rows >= 0)
+        user_ids = np.asarray(events["user_id"], dtype=np.int64)[useful]
+        return user_ids, track_rows[useful], weights[useful]
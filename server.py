@@ -0,0 +1,183 @@
+import argparse
+import asyncio
+import json
+from typing import Dict, List, Tuple
+
+import app
+from models.playlistCache import PlaylistCache
+
+# requests arriving within this many seconds are scored together
+default_batch_window = 0.005
+default_max_batch = 256
+
+
+class PlaylistBatcher:
+    # Collects playlist requests for one model and scores those that arrive
+    # within batch_window seconds with a single getPlaylists call, run in a
+    # worker thread so the event loop keeps accepting requests.
+    def __init__(
+        self,
+        model,
+        batch_window=default_batch_window,
+        max_batch=default_max_batch,
+    ) -> None:
+        self.model = model
+        self.batch_window = batch_window
+        self.max_batch = max_batch
+        self.pending: List[Tuple[List[int], int, asyncio.Future]] = []
+        self.flush_handle = None
+
+    async def get_playlist(
+        self, user_ids: List[int], number_of_songs: int
+    ) -> List[str]:
+        loop = asyncio.get_running_loop()
+        future = loop.create_future()
+        self.pending.append((user_ids, number_of_songs, future))
+        if len(self.pending) >= self.max_batch:
+            self._flush()
+        elif self.flush_handle is None:
+            self.flush_handle = loop.call_later(self.batch_window, self._flush)
+        return await future
+
+    def _flush(self) -> None:
+        if self.flush_handle is not None:
+            self.flush_handle.cancel()
+            self.flush_handle = None
+        batch, self.pending = self.pending, []
+
+        by_length: Dict[int, List] = {}
+        for request in batch:
+            by_length.setdefault(request[1], []).append(request)
+        for number_of_songs, requests in by_length.items():
+            asyncio.ensure_future(self._score(requests, number_of_songs))
+
+    async def _score(self, requests: List, number_of_songs: int) -> None:
+        loop = asyncio.get_running_loop()
+        groups = [user_ids for user_ids, _, _ in requests]
+        try:
+            playlists = await loop.run_in_executor(
+                None, self.model.getPlaylists, groups, number_of_songs
+            )
+        except Exception:
+            # one bad group (e.g. an unknown user) must not fail the others
+            for user_ids, _, future in requests:
+                try:
+                    playlist = await loop.run_in_executor(
+                        None, self.model.getPlaylist, user_ids, number_of_songs
+                    )
+                    future.set_result(playlist)
+                except Exception as error:
+                    future.set_exception(error)
+            return
+        for (_, _, future), playlist in zip(requests, playlists):
+            future.set_result(playlist)
+
+
+class PlaylistServer:
+    # Newline-delimited JSON over TCP. A request is
+    # {"user_ids": [...], "number_of_songs": 10}; the first user id is the
+    # one asking for the playlist and decides the A/B arm like in app.py.
+    def __init__(
+        self,
+        base_model,
+        target_model,
+        split_A_B=app.split_A_B,
+        batch_window=default_batch_window,
+        cache: PlaylistCache = None,
+    ) -> None:
+        self.split_A_B = split_A_B
+        self.cache = cache
+        self.batchers = {
+            "base": PlaylistBatcher(base_model, batch_window),
+            "target": PlaylistBatcher(target_model, batch_window),
+        }
+
+    async def playlist(self, request: Dict) -> Dict:
+        if not isinstance(request, dict):
+            return {"error": "request must be a JSON object"}
+        user_ids = request.get("user_ids")
+        if (
+            not isinstance(user_ids, list)
+            or not user_ids
+            or not all(isinstance(user_id, int) for user_id in user_ids)
+        ):
+            return {"error": "user_ids must be a non-empty list of integers"}
+        number_of_songs = request.get("number_of_songs", 10)
+        if not isinstance(number_of_songs, int) or number_of_songs < 1:
+            return {"error": "number_of_songs must be a positive integer"}
+
+        model_type = "base" if user_ids[0] > self.split_A_B else "target"
+        user_ids = list(dict.fromkeys(user_ids))
+        # checked up front so both arms reject the same requests
+        unknown = self.batchers[model_type].model.unknown_users(user_ids)
+        if unknown:
+            return {"error": f"Unknown user id: {unknown[0]}"}
+        if self.cache is not None:
+            tracks = self.cache.get(model_type, user_ids, number_of_songs)
+            if tracks is not None:
+                return {"tracks": tracks, "model_type": model_type}
+        try:
+            tracks = await self.batchers[model_type].get_playlist(
+                user_ids, number_of_songs
+            )
+        except KeyError as error:
+            return {"error": error.args[0]}
+        if self.cache is not None:
+            self.cache.put(model_type, user_ids, number_of_songs, tracks)
+        return {"tracks": tracks, "model_type": model_type}
+
+    async def handle(
+        self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter
+    ) -> None:
+        try:
+            while line := await reader.readline():
+                try:
+                    response = await self.playlist(json.loads(line))
+                except ValueError:
+                    response = {"error": "invalid JSON request"}
+                writer.write(json.dumps(response).encode() + b"\n")
+                await writer.drain()
+        finally:
+            writer.close()
+
+    async def serve(self, host: str, port: int) -> None:
+        server = await asyncio.start_server(self.handle, host, port)
+        async with server:
+            await server.serve_forever()
+
+
+async def request_playlist(
+    host: str, port: int, user_ids: List[int], number_of_songs=10
+) -> Dict:
+    reader, writer = await asyncio.open_connection(host, port)
+    request = {"user_ids": user_ids, "number_of_songs": number_of_songs}
+    writer.write(json.dumps(request).encode() + b"\n")
+    await writer.drain()
+    response = json.loads(await reader.readline())
+    writer.close()
+    await writer.wait_closed()
+    return response
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Playlist server")
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=8765)
+    parser.add_argument(
+        "--batch-window-ms", type=float, default=default_batch_window * 1000
+    )
+    args = parser.parse_args()
+
+    app.initialize_models()
+    server = PlaylistServer(
+        app.base_model,
+        app.target_model,
+        batch_window=args.batch_window_ms / 1000,
+        cache=app.playlist_cache,
+    )
+    print(f"Serving playlists on {args.host}:{args.port}")
+    asyncio.run(server.serve(args.host, args.port))
+
+
+if __name__ == "__main__":
+    main()